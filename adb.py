@@ -1,7 +1,31 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
+"""
+Thin wrapper over the adb client.
+
+Everything here is I/O-bound: the cost of a call is the adb process spawn plus the transport round-trip to the
+device (~150 ms per call measured for a single ``adb shell getprop``), while the Python-side parsing handles at most
+tens of KB. Optimizations should therefore target, in this order:
+
+- process reuse: commands go through one persistent ``adb shell`` session (``Adb._run_in_shell``);
+- call coalescing: read many properties in one round-trip (``get_all_properties``, ``get_properties_bulk``);
+- caching: property values are kept per device with a TTL, ``ro.*`` ones forever.
+
+Keep the shell hot path simple: single output stream, no extra decode passes.
+"""
+import asyncio
+import ctypes
+import functools
+import os
+import re
+import selectors
+import shlex
+import signal
 import subprocess
-from typing import List
+import sys
+import time
+from enum import Enum, unique
+from typing import Any, Awaitable, Callable, Dict, Iterable, Iterator, List, Tuple, Union
 
 import android_sdk
 
@@ -10,46 +34,401 @@ if android_sdk.get_module_version() < 1:
 
 list_str = List[str]
 
+
+@unique
+class Prop(str, Enum):
+    MODEL = "ro.product.model"
+    BRAND = "ro.product.brand"
+    MANUFACTURER = "ro.product.manufacturer"
+    DEVICE = "ro.product.device"
+    ABI = "ro.product.cpu.abi"
+    SERIAL = "ro.serialno"
+    ANDROID_VERSION = "ro.build.version.release"
+    SDK = "ro.build.version.sdk"
+    SECURITY_PATCH = "ro.build.version.security_patch"
+
+
+prop_name = Union[str, Prop]
+
 __version = 1
 
+_SHELL_TIMEOUT = 300.0  # default time a persistent shell may take to answer one command
+_READ_SIZE = 65536
+_USE_SELECTORS = os.name != "nt"  # selectors do not work with pipes on Windows
+_PROP_RE = re.compile(rb"^\[([^\]]+)\]: *\[(.*)\]\r?$", re.MULTILINE)
+_PROP_VALUE_MAX = 92  # <sys/system_properties.h>
+
+
+def _load_system_property_get():
+    try:
+        function = ctypes.CDLL("libc.so").__system_property_get
+    except (OSError, AttributeError):  # not running on Android itself
+        return None
+    function.argtypes = (ctypes.c_char_p, ctypes.c_char_p)
+    function.restype = ctypes.c_int
+    return function
+
+
+_system_property_get = _load_system_property_get()
+
 
 def get_module_version() -> int:
     return __version
 
 
+@functools.lru_cache(maxsize=None)
 def _get_adb(sdk_path: str) -> str:
     adb = android_sdk.AndroidSdk(sdk_path).get_adb()
     android_sdk.check_util_exists(adb)
     return adb
 
 
+def _canonical_prop(prop: prop_name) -> str:
+    # sys.intern() rejects str subclasses, so unwrap Prop members first
+    return sys.intern(prop.value if isinstance(prop, Prop) else prop)
+
+
+def _make_shell_prefix(adb: str, serial: str = None) -> Tuple[str, ...]:
+    return (adb, *(("-s", serial) if serial else ()), "shell")
+
+
+def _frame_command(command: str) -> Tuple[bytes, bytes, "re.Pattern[bytes]"]:
+    # A subshell with stdin from /dev/null keeps cd/export/exit/set -e and stdin readers from touching the session;
+    # the marker is random per exchange, so no output of the command can fake it
+    marker = f"__END_{os.urandom(8).hex()}__".encode("ascii")
+    frame = b"( " + command.encode("utf-8") + b"\n) </dev/null 2>&1; echo " + marker + b"$?\n"
+    return frame, marker, re.compile(re.escape(marker) + rb"(\d+)[ \t\r]*\n")
+
+
 def _prepare_output(output: bytes) -> list_str:
-    result = []
-    output = output.decode(encoding="utf-8", errors="replace").split('\n')
-    [result.append(line.strip()) for line in output if line not in ('', '\r', '\n', '\t')]
-    return output
+    return [line.decode(encoding="utf-8", errors="replace")
+            for line in (raw_line.strip() for raw_line in output.splitlines())
+            if line]
+
+
+def _parse_properties(output: bytes) -> Dict[str, str]:
+    # property names are ASCII, only values may need the UTF-8 decoder
+    return {match.group(1).decode("ascii", "replace"): match.group(2).decode("utf-8", "replace")
+            for match in _PROP_RE.finditer(output)}
+
+
+def _spawn(argv: Tuple[str, ...]) -> Tuple[int, bytes]:
+    if not hasattr(os, "posix_spawn"):
+        cmd = subprocess.run(argv, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+        return cmd.returncode, cmd.stdout
+
+    read_fd, write_fd = os.pipe()
+    pid = None
+    try:
+        file_actions = [(os.POSIX_SPAWN_OPEN, 0, os.devnull, os.O_RDONLY, 0),
+                        (os.POSIX_SPAWN_DUP2, write_fd, 1),
+                        (os.POSIX_SPAWN_DUP2, write_fd, 2),
+                        (os.POSIX_SPAWN_CLOSE, read_fd),
+                        (os.POSIX_SPAWN_CLOSE, write_fd)]
+        pid = os.posix_spawn(argv[0], argv, os.environ, file_actions=file_actions)
+        os.close(write_fd)
+        write_fd = None
+        chunks = []
+        while True:
+            chunk = os.read(read_fd, 65536)
+            if not chunk:
+                break
+            chunks.append(chunk)
+        _, status = os.waitpid(pid, 0)
+        pid = None
+        return os.waitstatus_to_exitcode(status), b"".join(chunks)
+    finally:
+        os.close(read_fd)
+        if write_fd is not None:
+            os.close(write_fd)
+        if pid is not None:  # interrupted before the child was reaped, do not leave a zombie behind
+            try:
+                os.kill(pid, signal.SIGKILL)
+            except ProcessLookupError:
+                pass
+            os.waitpid(pid, 0)
 
 
 class Adb:
-    def __init__(self, custom_sdk_path: str = None):
+    def __init__(self, custom_sdk_path: str = None, properties_ttl: float = 5.0, local: bool = False,
+                 persistent_shell: bool = True, shell_timeout: float = _SHELL_TIMEOUT):
         self._adb = _get_adb(custom_sdk_path)
+        self._local = local
+        self._persistent_shell = persistent_shell
+        self._shell_timeout = shell_timeout
         self._device = None
-        self._shell = None
+        self._shell_prefix = _make_shell_prefix(self._adb)
+        self._shell_process = None
+        self._shell_selector = None
+        self._shell_buffer = bytearray()
+        self._properties_ttl = properties_ttl
+        self._prop_cache: Dict[Tuple[str, str], Tuple[float, str]] = {}
+        self._getprop_bin = None
+
+    def __enter__(self) -> "Adb":
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def _get_shell_process(self) -> subprocess.Popen:
+        if self._shell_process is None or self._shell_process.poll() is not None:
+            self._shell_process = subprocess.Popen(self._shell_prefix, stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                                                   stderr=subprocess.STDOUT, bufsize=0)
+            self._shell_buffer.clear()
+            if _USE_SELECTORS:
+                if self._shell_selector is not None:
+                    self._shell_selector.close()
+                self._shell_selector = selectors.DefaultSelector()
+                self._shell_selector.register(self._shell_process.stdout, selectors.EVENT_READ)
+        return self._shell_process
+
+    def _run_in_shell(self, command: str, merge_stderr: bool = True, timeout: float = None) -> Tuple[int, bytes]:
+        if not merge_stderr:
+            command = f"{{ {command}; }} 2>/dev/null"
+        if not self._persistent_shell:
+            return _spawn((*self._shell_prefix, command))
+        if timeout is None:
+            timeout = self._shell_timeout
+        frame, marker, end_re = _frame_command(command)
+        process = self._get_shell_process()
+        process.stdin.write(frame)
+        if _USE_SELECTORS:
+            return self._read_framed_output(process, command, marker, end_re, timeout)
+        return self._read_framed_lines(process, command, end_re)
+
+    def _read_framed_output(self, process: subprocess.Popen, command: str, marker: bytes, end_re: "re.Pattern[bytes]",
+                            timeout: float = None) -> Tuple[int, bytes]:
+        buffer = self._shell_buffer
+        deadline = None if timeout is None else time.monotonic() + timeout
+        fd = process.stdout.fileno()
+        position = 0
+        while True:
+            index = buffer.find(marker, position)
+            while index != -1:
+                match = end_re.match(buffer, index)
+                if match is not None:
+                    exit_code, output = int(match.group(1)), bytes(buffer[:index])
+                    del buffer[:match.end()]
+                    return exit_code, output
+                if buffer.find(b"\n", index) == -1:
+                    break  # the marker line is not complete yet
+                index = buffer.find(marker, index + 1)
+            position = index if index != -1 else max(0, len(buffer) - len(marker))
+
+            remaining = None if deadline is None else deadline - time.monotonic()
+            if remaining is not None and remaining <= 0 or not self._shell_selector.select(remaining):
+                self.close()
+                raise TimeoutError(f"adb shell did not answer '{command}' in {timeout} seconds")
+            chunk = os.read(fd, _READ_SIZE)
+            if not chunk:
+                self.close()
+                raise ConnectionError(f"adb shell terminated while executing '{command}'")
+            buffer += chunk
+
+    def _read_framed_lines(self, process: subprocess.Popen, command: str,
+                           end_re: "re.Pattern[bytes]") -> Tuple[int, bytes]:
+        # no selectors for pipes on Windows, so there is no way to stop waiting for a hung command here
+        output = []
+        while True:
+            line = process.stdout.readline()
+            if not line:
+                self.close()
+                raise ConnectionError(f"adb shell terminated while executing '{command}'")
+            match = end_re.search(line)
+            if match is not None:
+                output.append(line[:match.start()])
+                return int(match.group(1)), b"".join(output)
+            output.append(line)
 
     def _execute_shell_command(self, *args) -> list_str:
-        cmd = subprocess.run((*self.get_shell(), *args), stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
-        return _prepare_output(cmd.stdout)
+        _, output = self._run_in_shell(shlex.join(args))
+        return _prepare_output(output)
+
+    def _iter_shell_command(self, *args) -> Iterator[str]:
+        with subprocess.Popen((*self._shell_prefix, *args), stdin=subprocess.DEVNULL, stdout=subprocess.PIPE,
+                              stderr=subprocess.DEVNULL) as process:
+            try:
+                for raw_line in process.stdout:
+                    line = raw_line.strip()
+                    if line:
+                        yield line.decode(encoding="utf-8", errors="replace")
+            finally:
+                if process.poll() is None:  # the caller stopped early, do not wait for the rest of output
+                    process.kill()
+
+    def close(self):
+        process, self._shell_process = self._shell_process, None
+        if self._shell_selector is not None:
+            self._shell_selector.close()
+            self._shell_selector = None
+        self._shell_buffer.clear()
+        if process is None:
+            return
+        if process.poll() is None:
+            try:
+                process.stdin.write(b"exit\n")
+                process.wait(timeout=2)
+            except (OSError, subprocess.TimeoutExpired):
+                process.kill()
+                process.wait()
+        process.stdin.close()
+        process.stdout.close()
 
     def set_device(self, serial: str):
+        if serial != self._device:
+            self.close()
+            self._getprop_bin = None
+            self.invalidate_properties()
         self._device = serial
+        self._shell_prefix = _make_shell_prefix(self._adb, serial)
 
     def get_shell(self) -> list_str:
-        if self._shell is None:
-            self._shell = [self._adb]
-            if self._device:
-                self._shell.extend(["-s", self._device])
-            self._shell.append("shell")
-        return self._shell
-
-    def get_properties(self, prop: str) -> str:
-        return self._execute_shell_command("getprop", prop)[0]
+        return list(self._shell_prefix)
+
+    def _get_getprop_bin(self) -> str:
+        if self._getprop_bin is None:
+            # some builds answer plain "getprop" with "applet not found"
+            _, output = self._run_in_shell("command -v getprop || echo /system/bin/getprop", merge_stderr=False)
+            lines = _prepare_output(output)
+            self._getprop_bin = lines[-1] if lines else "/system/bin/getprop"
+        return self._getprop_bin
+
+    def invalidate_properties(self):
+        self._prop_cache.clear()
+
+    def get_all_properties(self) -> Dict[str, str]:
+        _, output = self._run_in_shell(shlex.quote(self._get_getprop_bin()), merge_stderr=False)
+        properties = _parse_properties(output)
+        now = time.monotonic()
+        for prop, value in properties.items():
+            self._prop_cache[(self._device, prop)] = (now, value)
+        return properties
+
+    def _get_local_property(self, prop: str) -> str:
+        value = ctypes.create_string_buffer(_PROP_VALUE_MAX)
+        _system_property_get(prop.encode("utf-8"), value)
+        return value.value.decode(encoding="utf-8", errors="replace")
+
+    def get_properties(self, prop: prop_name) -> str:
+        prop = _canonical_prop(prop)
+        if self._local and _system_property_get is not None:
+            return self._get_local_property(prop)
+        key = (self._device, prop)
+        cached = self._prop_cache.get(key)
+        # ro.* properties are set once at boot and never change until reboot
+        if cached is not None and (prop.startswith("ro.") or time.monotonic() - cached[0] < self._properties_ttl):
+            return cached[1]
+        if self._persistent_shell:
+            value = self.get_all_properties().get(prop, "")
+        else:
+            value = next(self._iter_shell_command(self._get_getprop_bin(), prop), "")
+        self._prop_cache[key] = (time.monotonic(), value)
+        return value
+
+    def get_properties_bulk(self, props: List[prop_name]) -> Dict[str, str]:
+        if not props:
+            return {}
+        props = [_canonical_prop(prop) for prop in props]
+        getprop = shlex.quote(self._get_getprop_bin())
+        _, output = self._run_in_shell("; ".join(f"{getprop} {shlex.quote(prop)}" for prop in props),
+                                       merge_stderr=False)
+        values = output.decode(encoding="utf-8", errors="replace").splitlines()
+        values.extend([""] * (len(props) - len(values)))
+        return {prop: value.strip() for prop, value in zip(props, values)}
+
+
+class AsyncAdb:
+    def __init__(self, custom_sdk_path: str = None, serial: str = None, shell_timeout: float = _SHELL_TIMEOUT):
+        self._adb = _get_adb(custom_sdk_path)
+        self._device = serial
+        self._shell_timeout = shell_timeout
+        self._shell_prefix = _make_shell_prefix(self._adb, serial)
+        self._shell_process = None
+        self._lock = asyncio.Lock()
+
+    async def __aenter__(self) -> "AsyncAdb":
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        await self.close()
+
+    def get_shell(self) -> list_str:
+        return list(self._shell_prefix)
+
+    async def _get_shell_process(self) -> asyncio.subprocess.Process:
+        if self._shell_process is None or self._shell_process.returncode is not None:
+            self._shell_process = await asyncio.create_subprocess_exec(*self._shell_prefix, stdin=subprocess.PIPE,
+                                                                       stdout=subprocess.PIPE,
+                                                                       stderr=subprocess.STDOUT)
+        return self._shell_process
+
+    async def _run_in_shell(self, command: str, merge_stderr: bool = True,
+                            timeout: float = None) -> Tuple[int, bytes]:
+        if not merge_stderr:
+            command = f"{{ {command}; }} 2>/dev/null"
+        if timeout is None:
+            timeout = self._shell_timeout
+        frame, _, end_re = _frame_command(command)
+        async with self._lock:
+            process = await self._get_shell_process()
+            process.stdin.write(frame)
+            await process.stdin.drain()
+            try:
+                return await asyncio.wait_for(self._read_framed_lines(process, command, end_re), timeout)
+            except asyncio.TimeoutError:
+                self._shell_process = None
+                process.kill()
+                await process.wait()
+                raise TimeoutError(f"adb shell did not answer '{command}' in {timeout} seconds") from None
+
+    @staticmethod
+    async def _read_framed_lines(process: asyncio.subprocess.Process, command: str,
+                                 end_re: "re.Pattern[bytes]") -> Tuple[int, bytes]:
+        output = []
+        while True:
+            line = await process.stdout.readline()
+            if not line:
+                raise ConnectionError(f"adb shell terminated while executing '{command}'")
+            match = end_re.search(line)
+            if match is not None:
+                output.append(line[:match.start()])
+                return int(match.group(1)), b"".join(output)
+            output.append(line)
+
+    async def _execute_shell_command(self, *args) -> list_str:
+        _, output = await self._run_in_shell(shlex.join(args))
+        return _prepare_output(output)
+
+    async def get_all_properties(self) -> Dict[str, str]:
+        _, output = await self._run_in_shell("getprop", merge_stderr=False)
+        return _parse_properties(output)
+
+    async def get_properties(self, prop: prop_name) -> str:
+        prop = _canonical_prop(prop)
+        _, output = await self._run_in_shell(shlex.join(("getprop", prop)), merge_stderr=False)
+        lines = _prepare_output(output)
+        return lines[0] if lines else ""
+
+    async def close(self):
+        process, self._shell_process = self._shell_process, None
+        if process is None:
+            return
+        if process.returncode is None:
+            try:
+                process.stdin.write(b"exit\n")
+                await asyncio.wait_for(process.wait(), timeout=2)
+            except (OSError, asyncio.TimeoutError):
+                process.kill()
+                await process.wait()
+
+
+async def fan_out(serials: Iterable[str], coro: Callable[[AsyncAdb], Awaitable[Any]],
+                  custom_sdk_path: str = None) -> Dict[str, Any]:
+    # a failure on one device is returned as that device's result, so the others finish before their shells close
+    devices = [AsyncAdb(custom_sdk_path, serial) for serial in serials]
+    try:
+        results = await asyncio.gather(*(coro(device) for device in devices), return_exceptions=True)
+    finally:
+        await asyncio.gather(*(device.close() for device in devices), return_exceptions=True)
+    return {device._device: result for device, result in zip(devices, results)}
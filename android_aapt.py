@@ -1,14 +1,20 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
+import functools
 import os
 
 import remove_android_sdk
 from remove_android_sdk import PathLike
 
 
+@functools.lru_cache(maxsize=None)
+def _normalize(path: PathLike) -> PathLike:
+    return os.path.expanduser(os.path.expandvars(path))
+
+
 class AndroidAapt(object):
     def __init__(self, path: PathLike) -> None:
-        self.__aapt = os.path.expanduser(os.path.expandvars(path))
+        self.__aapt = _normalize(path)
 
 
 if __name__ == '__main__':
@@ -1,10 +1,15 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
+import functools
 import os
 import platform
+from typing import Final
 
 __version = 1
 
+_IS_WINDOWS: Final = platform.system() == "Windows"
+_EXE_SUFFIX: Final = '.exe' if _IS_WINDOWS else ''
+
 
 def get_module_version() -> int:
     return __version
@@ -15,22 +20,45 @@ def _check_dir_exist(dir_path: str):
         raise NotADirectoryError(f"Directory '{dir_path}' does not exist")
 
 
+def _expand_sdk_path(path: str) -> str:
+    if "$" in path or "%" in path:
+        path = os.path.expandvars(path)
+    if path.startswith("~"):
+        path = os.path.expanduser(path)
+    _check_dir_exist(path)
+    return path
+
+
+@functools.lru_cache(maxsize=None)
+def _resolve_env_sdk() -> str:
+    for env in ("ANDROID_SDK_ROOT", "ANDROID_HOME"):  # https://developer.android.com/studio/command-line/variables
+        value = os.getenv(env)
+        if value:
+            return _expand_sdk_path(value)
+    raise ValueError("Environment variable 'ANDROID_SDK_ROOT' does not set. Cannot find Android SDK directory")
+
+
 def _resolve_sdk_path(custom_path: str = None) -> str:
     if custom_path is None:
-        for env in ("ANDROID_SDK_ROOT", "ANDROID_HOME"):  # https://developer.android.com/studio/command-line/variables
-            if os.getenv(env) is not None:
-                custom_path = env
-                break
-        if custom_path is None:
-            raise ValueError("Environment variable 'ANDROID_SDK_ROOT' does not set. Cannot find Android SDK directory")
-
-    custom_path = os.path.expanduser(os.path.expandvars(custom_path))
-    _check_dir_exist(custom_path)
-    return custom_path
+        return _resolve_env_sdk()
+    return _expand_sdk_path(custom_path)
 
 
 def _get_bin_name(file_name: str) -> str:
-    return file_name + '.exe' if platform.system() == "Windows" else file_name
+    return file_name + _EXE_SUFFIX
+
+
+_UTIL_NAMES: Final = {
+    "adb": _get_bin_name("adb"),
+    "aapt": _get_bin_name("aapt"),
+    "zipalign": _get_bin_name("zipalign"),
+    "apksigner": _get_bin_name("apksigner"),
+}
+_ADB_REL: Final = os.path.join("platform-tools", _UTIL_NAMES["adb"])
+
+
+def _version_key(version: str) -> tuple:
+    return tuple(int(part) for part in version.split('.') if part.isdigit())
 
 
 def check_util_exists(file_path: str):
@@ -39,28 +67,63 @@ def check_util_exists(file_path: str):
 
 
 class AndroidSdk:
+    __slots__ = ("_sdk", "adb", "_build_tools_path", "_aapt", "_apksigner", "_zipalign")
+
     def __init__(self, custom_path: str = None):
         self._sdk = _resolve_sdk_path(custom_path)
-
-    def get_build_tools(self) -> str:
+        self.adb = os.path.join(self._sdk, _ADB_REL)
+        self._build_tools_path = None
+        self._aapt = None
+        self._apksigner = None
+        self._zipalign = None
+
+    @property
+    def build_tools(self) -> str:
+        if self._build_tools_path is None:
+            self._build_tools_path = self._find_build_tools()
+        return self._build_tools_path
+
+    def _find_build_tools(self) -> str:
         build_tools_dir = os.path.join(self._sdk, "build-tools")
         _check_dir_exist(build_tools_dir)
-        versions = os.listdir(build_tools_dir)
-        sorted(versions, reverse=True)  # from new to old
+        with os.scandir(build_tools_dir) as entries:
+            versions = [entry for entry in entries if entry.is_dir()]
+        versions.sort(key=lambda entry: _version_key(entry.name), reverse=True)  # from new to old
         for version in versions:
-            path = os.path.join(build_tools_dir, version)
-            if os.listdir(path):
-                return path
+            with os.scandir(version.path) as files:
+                if next(files, None) is not None:
+                    return version.path
         raise FileNotFoundError(f"No any files found in subdirectories under {build_tools_dir}")
 
+    @property
+    def aapt(self) -> str:
+        if self._aapt is None:
+            self._aapt = os.path.join(self.build_tools, _UTIL_NAMES["aapt"])
+        return self._aapt
+
+    @property
+    def apksigner(self) -> str:
+        if self._apksigner is None:
+            self._apksigner = os.path.join(self.build_tools, _UTIL_NAMES["apksigner"])
+        return self._apksigner
+
+    @property
+    def zipalign(self) -> str:
+        if self._zipalign is None:
+            self._zipalign = os.path.join(self.build_tools, _UTIL_NAMES["zipalign"])
+        return self._zipalign
+
+    def get_build_tools(self) -> str:
+        return self.build_tools
+
     def get_adb(self) -> str:
-        return os.path.join(self._sdk, "platform-tools", _get_bin_name("adb"))
+        return self.adb
 
     def get_aapt(self) -> str:
-        return os.path.join(self.get_build_tools(), _get_bin_name("aapt"))
+        return self.aapt
 
     def get_apksigner(self) -> str:
-        return os.path.join(self.get_build_tools(), _get_bin_name("apksigner"))
+        return self.apksigner
 
     def get_zipalign(self) -> str:
-        return os.path.join(self.get_build_tools(), _get_bin_name("zipalign"))
+        return self.zipalign
@@ -1,22 +1,61 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
+import asyncio
+import collections
+import concurrent.futures
+import copy
+import hashlib
 import os
 import re
+import selectors
+import shlex
+import shutil
 import subprocess
+import tarfile
+import threading
 import time
+import warnings
+import weakref
 from enum import Enum, unique
-from typing import Iterable
+from typing import Iterable, Iterator
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
 
 import remove_android_sdk
 from remove_android_sdk import PathLike
 
 
+# Начиная с Python 3.4 дескрипторы и так не наследуются, а без close_fds на POSIX subprocess может запускать adb
+# через vfork/posix_spawn, не перебирая все открытые дескрипторы. На Windows оставляем поведение по умолчанию
+_CLOSE_FDS = os.name == 'nt'
+_END_MARKER = '__END_%s__'  # в маркер подставляется случайная строка, своя на каждый обмен с shell
+_USE_SELECTORS = os.name != 'nt'  # на Windows selectors не работают с трубами
+_READ_SIZE = 65536
+_LOGCAT_PIPE_SIZE = 1 << 20
+_PROP_RE = re.compile(r'^\[([^\]]+)\]: \[(.*)\]$')
+_DEVICE_TMP = '/data/local/tmp/'
+# Python 3.12+ предупреждает, если распаковывать tar без фильтра
+_TAR_EXTRACT_KWARGS = {'filter': 'data'} if hasattr(tarfile, 'data_filter') else {}
+_AM_START_PREFIX = ('am', 'start', '-n')
+_DEVICE_RE = re.compile(r'^(\S+)\s+(\S+)\s*(.*)$')
+_KV_RE = re.compile(r'(\w+):(\S+)')
+_LS_ERR_SUFFIXES = ('Permission denied', 'No such file or directory')
+_PUSH_DIR_ERRORS = ('No such file or directory', 'is not a directory')
+_LA_RE = re.compile(r'^([drwx-]*) +(\d*) *(\w+) +(\w+) *(\d*) +([\d\-]+) +([\d:]+) (.*)$')
+
+
 @unique
 class Mode(Enum):
     INSTALL = "Installation"
     UNINSTALL = "Uninstalling"
 
 
+_MODE_ERRORS = {mode: mode.value + ' error: ' for mode in Mode}
+
+
 class AdbError(Exception):
     def __init__(self) -> None:
         pass
@@ -64,34 +103,231 @@ class AndroidEnvironmentError(AdbError):
 
 def _prepare_output(raw_output: bytes) -> list:
     """
-    Сделать из байтов читабельный текст. Будет проведено декодирование, затем разделение строк, затем каждрая строка
-    будет проверена на вменяемость. Если проверку проходит — добавляется в список строк, которые будут отданы наружу.
-    Перед помещением строки в список у неё откусываются символы перевода строки.
+    Сделать из байтов читабельный текст. Будет проведено декодирование, затем разделение строк, у каждой строки
+    откусываются пробельные символы по краям. Строки, от которых после этого ничего не осталось, выбрасываются.
 
     :param raw_output: типичный выхлоп subprocess.run()/.Popen() без предварительной подготовки
     :return: список читабельных строк без лишнего мусора
     """
-    output = []
-    if raw_output:
-        raw_output = raw_output.decode().split('\n')
-        [output.append(line.strip()) for line in raw_output if line not in ('', '\r', '\n', '\t')]
-    return output
+    if not raw_output:
+        return []
+    return [line.decode('utf-8', 'replace') for line in (raw_line.strip() for raw_line in raw_output.splitlines())
+            if line]
 
 
-def _execute_command(args: list, output: bool = True) -> list:
+def _iter_command(args: list, capture_stderr: bool = True) -> Iterator[str]:
+    """
+    Выполняет переданную команду и отдаёт её вывод построчно, по мере поступления. Строки очищены от мусора так же,
+     как в _prepare_output(). Если перестать читать раньше времени, процесс будет убит
+
+    :param args: список аргументов, которые будут переданы subprocess.Popen()
+    :param capture_stderr: подмешивать ли stderr в вывод. Если False, stderr выбрасывается
+    :return: генератор строк
+    """
+    stderr = subprocess.STDOUT if capture_stderr else subprocess.DEVNULL
+    with subprocess.Popen(args, stdout=subprocess.PIPE, stderr=stderr, close_fds=_CLOSE_FDS,
+                          encoding='utf-8', errors='replace') as process:
+        try:
+            for raw_line in process.stdout:
+                line = raw_line.strip()
+                if line:
+                    yield line
+        finally:
+            if process.poll() is None:
+                process.kill()
+
+
+def _execute_command(args: list, output: bool = True, capture_stderr: bool = True) -> list:
     """
     Выполняет переданную команду и возвращает список строк, которые предварительно были очищены от мусора
 
     :param args: список аргументов, которые будут переданы subprocess.run()
     :param output: нужен ли вам обратно текстовый выхлоп команды
+    :param capture_stderr: подмешивать ли stderr в вывод. Ошибки adb (например, у push) приходят именно туда, так что
+     выключайте, только если они точно не нужны
     :return: список строк, предварительно очищенных от мусора. Если параметр output был False, то список будет пустым
     """
     if output:
-        raw_output = subprocess.run(args, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
-        return _prepare_output(raw_output.stdout)
+        return list(_iter_command(args, capture_stderr))
     else:
-        subprocess.run(args, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        subprocess.run(args, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, close_fds=_CLOSE_FDS)
+        return []
+
+
+def _execute_command_tail(args: list, size: int = 4096) -> tuple:
+    """
+    Выполняет переданную команду и разбирает только хвост её вывода. Подходит для команд, у которых значим лишь
+     итог в конце, а перед ним идёт много прогресса, как у adb install
+
+    :param args: список аргументов, которые будут переданы subprocess.run()
+    :param size: сколько последних байт вывода разбирать
+    :return: кортеж (код возврата, список строк из хвоста вывода, очищенных от мусора). stderr попадает в список
+     только при ненулевом коде возврата, перед stdout. Первая строка может оказаться обрезанной
+    """
+    result = subprocess.run(args, stdout=subprocess.PIPE, stderr=subprocess.PIPE, close_fds=_CLOSE_FDS)
+    return result.returncode, _tail_output(result.returncode, result.stdout, result.stderr, size)
+
+
+def _tail_output(returncode: int, stdout: bytes, stderr: bytes, size: int) -> list:
+    """
+    Разобрать хвосты stdout и stderr команды, см. _execute_command_tail()
+
+    :param returncode: код возврата команды
+    :param stdout: stdout команды
+    :param stderr: stderr команды
+    :param size: сколько последних байт каждого потока разбирать
+    :return: список строк
+    """
+    output = _prepare_output(stdout[-size:])
+    if returncode != 0:
+        output = _prepare_output(stderr[-size:]) + output
+    return output
+
+
+def _execute_command_async(args: list) -> subprocess.Popen:
+    """
+    Запустить команду и сразу вернуть управление, не дожидаясь её завершения. Вывод команды выбрасывается
+
+    :param args: список аргументов, которые будут переданы subprocess.Popen()
+    :return: запущенный процесс
+    """
+    return subprocess.Popen(args, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, close_fds=_CLOSE_FDS)
+
+
+async def _run_command_async(args: list, tail: int = 4096) -> tuple:
+    """
+    Выполнить команду, не блокируя цикл событий, и разобрать хвост её вывода, как это делает
+     _execute_command_tail()
+
+    :param args: список аргументов для asyncio.create_subprocess_exec()
+    :param tail: сколько последних байт вывода разбирать
+    :return: кортеж (код возврата, список строк, очищенных от мусора)
+    """
+    process = await asyncio.create_subprocess_exec(*args, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    out, err = await process.communicate()
+    return process.returncode, _tail_output(process.returncode, out, err, tail)
+
+
+async def _start_logcat_async(base_command: tuple, *args) -> asyncio.subprocess.Process:
+    """
+    Запустить adb logcat с переданными аргументами, не блокируя цикл событий
+
+    :param base_command: начало команды: путь к adb и, если нужно, -s serial
+    :param args: аргументы для logcat
+    :return: запущенный процесс, из stdout которого можно читать асинхронно
+    """
+    return await asyncio.create_subprocess_exec(*base_command, 'logcat', *args, stdout=subprocess.PIPE)
+
+
+async def _collect_logcat_async(stream: asyncio.StreamReader, search_start, search_end, decode: str) -> list:
+    """
+    Асинхронно накапливать строки логката, пока не встретим ключевую. Логика та же, что и в
+     AndroidAdb.read_logcat_while_lines()
+
+    :param stream: stdout процесса логката
+    :param search_start: функция поиска стартовой строки в байтах или None, если копить нужно сразу
+    :param search_end: функция поиска финальной строки в байтах
+    :param decode: кодировка логката
+    :return: список накопленных строк
+    """
+    result = []
+    can_start = search_start is None
+    async for raw_line in stream:
+        if not can_start:
+            if search_start(raw_line):
+                can_start = True
+        if can_start:
+            raw_line = raw_line.strip()
+            if raw_line:
+                result.append(raw_line.decode(decode, 'replace'))
+        if search_end(raw_line):
+            break
+    return result
+
+
+def _logcat_buffer_args(buffers: Iterable = None) -> list:
+    """
+    Собрать ключи logcat для чтения нескольких буферов одним процессом
+
+    :param buffers: имена буферов, например ('main', 'events') или ('all',)
+    :return: список ключей. Каждый буфер передаётся отдельным -b, так понимают и старые версии logcat, а -D
+     (Android 7+) печатает разделитель при переходе между буферами
+    """
+    if not buffers:
         return []
+    command = []
+    for buffer in buffers:
+        command.extend(['-b', buffer])
+    command.append('-D')
+    return command
+
+
+def _grow_pipe(stream, size: int = _LOGCAT_PIPE_SIZE) -> None:
+    """
+    Увеличить буфер трубы, чтобы всплески логката не упирались в стандартные 64 КБ, пока читающий поток занят.
+     Работает только на Linux, в остальных случаях ничего не делает
+
+    :param stream: конец трубы, которую нужно расширить
+    :param size: желаемый размер буфера в байтах. Ядро может урезать его до /proc/sys/fs/pipe-max-size
+    """
+    if fcntl is None or not hasattr(fcntl, 'F_SETPIPE_SZ'):
+        return
+    try:
+        fcntl.fcntl(stream.fileno(), fcntl.F_SETPIPE_SZ, size)
+    except OSError:
+        pass
+
+
+def _drain_logcat(stream, lines: collections.deque, condition: threading.Condition) -> None:
+    """
+    Читать вывод логката в фоне и складывать сырые строки в кольцевой буфер, чтобы adb не вставал на заполненной
+     трубе. Когда логкат завершится, в буфер кладётся None — признак конца
+
+    :param stream: stdout процесса логката
+    :param lines: буфер строк. Если у него задан maxlen, самые старые строки вытесняются
+    :param condition: условие, через которое будим читателей буфера
+    """
+    try:
+        for raw_line in iter(stream.readline, b''):
+            with condition:
+                lines.append(raw_line)
+                condition.notify_all()
+    except (OSError, ValueError):  # трубу закрыли у нас из-под носа
+        pass
+    finally:
+        with condition:
+            lines.append(None)
+            condition.notify_all()
+
+
+def _write_quietly(stream, data: bytes) -> None:
+    """
+    Записать данные в трубу процесса целиком. Если процесс умер, молча выходим: читающая сторона сама это увидит
+
+    :param stream: stdin процесса
+    :param data: что записать
+    """
+    try:
+        stream.write(data)
+    except (OSError, ValueError):  # ValueError — трубу уже закрыли в close_shell()
+        pass
+
+
+def _close_process(process: subprocess.Popen) -> None:
+    """
+    Корректно завершить shell-процесс adb: попросить выйти, подождать, а если не послушался — убить
+
+    :param process: процесс, запущенный через subprocess.Popen() со stdin=PIPE
+    """
+    if process.poll() is None:
+        try:
+            process.stdin.write(b'exit\n')
+            process.wait(timeout=2)
+        except (OSError, subprocess.TimeoutExpired):
+            process.kill()
+            process.wait()
+    process.stdin.close()
+    process.stdout.close()
 
 
 def __process_la(ls_la_lines: list) -> list:
@@ -101,13 +337,12 @@ def __process_la(ls_la_lines: list) -> list:
     :return: список из словарей с ключами:
      права, количество ссылок на объект, владелец, группа, размер, дата, время, имя
     """
-    pattern = re.compile('^([drwx-]*) +(\d*) *(\w+) +(\w+) *(\d*) +([\d\-]+) +([\d:]+) (.*)$')
     result = []
-    description = {}
     for string in ls_la_lines:
-        match = re.match(pattern, string)
+        match = _LA_RE.match(string)
         if match is not None:
             if not string.endswith('.'):
+                description = {}
                 description['rights'] = match.group(1)
                 description['links'] = match.group(2)
                 description['owner'] = match.group(3)
@@ -130,9 +365,9 @@ def _parse_la(la_result: list) -> tuple:
     errors = []
     ok_strings = []
     for la in la_result:
-        if any([la.endswith('Permission denied'),
-                la.endswith('No such file or directory'),]):
-            errors.append((la.split(': ')[-2], la.split(': ')[-1]))
+        if la.endswith(_LS_ERR_SUFFIXES):
+            parts = la.rsplit(': ', 2)
+            errors.append((parts[-2], parts[-1]))
         else:
             ok_strings.append(la)
     if ok_strings:
@@ -140,12 +375,13 @@ def _parse_la(la_result: list) -> tuple:
     return ok_strings, errors
 
 
-def _check_install_remove(output: list, command: Mode) -> dict:
+def _check_install_remove(output: list, command: Mode, returncode: int = None) -> dict:
     """
     Проверяем, успешно ли прошла установка/удаление
 
     :param output: выхлоп команды install/uninstall в виде списка строк
     :param command: енамчик, по которому можно понять, это была установка или удаление
+    :param returncode: код возврата команды. Если в выводе нет ни Success, ни Failure, решаем по нему
     :return: словарь {'Success': bool, 'Message': str}. 'Message' есть только в случае проблем установки
     """
     command_result = {}
@@ -154,51 +390,96 @@ def _check_install_remove(output: list, command: Mode) -> dict:
             command_result["Success"] = True
         elif 'Failure' in line:
             command_result = {"Message": line.split(' ')[-1]}
-            raise InstallRemoveError(command.value + ' error: ' + command_result["Message"])
+            raise InstallRemoveError(_MODE_ERRORS[command] + command_result["Message"])
+    if returncode is not None and not command_result:
+        if returncode == 0:
+            command_result["Success"] = True
+        else:
+            raise InstallRemoveError(_MODE_ERRORS[command] + (output[-1] if output else 'exit code %d' % returncode))
     return command_result
 
 
 class AndroidAdb(object):
-    def __init__(self, path: PathLike) -> None:
+    def __init__(self, path: PathLike, devices_ttl: float = 2.0, props_ttl: float = 5.0,
+                 shell_timeout: float = 300.0) -> None:
         """
         Получаем adb и работаем с ним
 
-        :param path: путь к adb. Его можно спросить у AndroidSdk()
-        """
-        self.__adb = os.path.expanduser(os.path.expandvars(path))
+        :param path: путь к adb. Его можно спросить у AndroidSdk(). Путь проверяется и разворачивается в настоящий
+         сразу, так что неверный путь даст FileNotFoundError здесь, а не на первой команде
+        :param devices_ttl: сколько секунд get_devices() может отдавать запомненный список устройств, не спрашивая adb
+        :param props_ttl: сколько секунд get_prop() может отдавать запомненные изменяемые property. Property ro.*
+         не меняются до перезагрузки, поэтому запоминаются до смены устройства или refresh_props()
+        :param shell_timeout: сколько секунд ждать ответа долгоживущего shell на пачку команд. Если не дождались,
+         shell закрывается и бросается TimeoutError. None — ждать сколько угодно (на Windows таймаут не работает)
+        """
+        adb = os.path.expanduser(os.path.expandvars(path))
+        resolved = shutil.which(adb)  # заодно проверяет права на запуск и понимает голое имя из PATH
+        if resolved is None:
+            raise FileNotFoundError(f'"{adb}" not found or not executable')
+        self.__adb = os.path.realpath(resolved)
         self.__device = None
+        self.__base_command = (self.__adb,)
         self.__logcat = None
+        self.__logcat_lines = None
+        self.__logcat_condition = None
+        self.__logcat_thread = None
         self.__package = None
-        self.__exit_lines = set()
-
-    def get_devices(self) -> list:
+        self.__exit_lines = frozenset()
+        self.__shell = None
+        self.__shell_finalizer = None
+        self.__shell_lock = threading.Lock()
+        self.__shell_timeout = shell_timeout
+        self.__prop_cache = {}
+        self.__props_time = None
+        self.__props_ttl = props_ttl
+        self.__sdk_version = None
+        self.__runtime_permissions = None
+        self.__devices_ttl = devices_ttl
+        self.__devices_cache = (0.0, None)
+        self.__pattern_cache = {}
+        self.__pending = []
+        self.__packages_cache = None
+
+    def get_devices(self, max_age: float = None) -> list:
         """
         Получение всех подключенных устройств
 
-        :return: Список подключенных устройств в формате [{'serial': serial, 'description':{key:value}}]
+        :param max_age: насколько старый запомненный список нас устроит, в секундах. По умолчанию devices_ttl из
+         конструктора, 0 — обязательно спросить adb
+        :return: Список подключенных устройств в формате [{'serial': serial, 'type': type, 'description':{key:value}}]
         serial — id устройства, по которому можно делать adb -s
+        type — состояние устройства: device, offline, unauthorized и т.п.
         description — словарь, описывающий устройство, например модель
         Если ни одного устройства не подключено, то будет либо исключение, либо пустой список
+        Результат запоминается на devices_ttl секунд, см. invalidate_devices_cache()
         """
-        output = _execute_command([self.__adb, 'devices', '-l'])
+        if max_age is None:
+            max_age = self.__devices_ttl
+        timestamp, cached = self.__devices_cache
+        if cached is not None and time.monotonic() - timestamp < max_age:
+            return [{'serial': d['serial'], 'type': d['type'], 'description': dict(d['description'])} for d in cached]
+
+        output = _execute_command([self.__adb, 'devices', '-l'], capture_stderr=False)
         devices = []
         for line in output:
-            if not any([line.startswith('List of'), line.startswith('*')]):
-                device_dict = {}
-
-                serial_type_desc = line.split('   ')
-                d_serial = serial_type_desc[0]
-                d_type_desc = serial_type_desc[-1].split(' ')
-                # d_type = d_type_desc[1]
-                # d_desc = _get_device_descriptions(d_type_desc[2:])
-                d_desc = dict(x.split(':') for x in d_type_desc[2:])
-                device_dict['serial'] = d_serial
-                # device_dict['type'] = d_type
-                device_dict['description'] = d_desc
-                devices.append(device_dict)
+            if line.startswith(('List of', '*')):
+                continue
+            match = _DEVICE_RE.match(line)
+            if match is not None:
+                devices.append({'serial': match.group(1), 'type': match.group(2),
+                                'description': dict(_KV_RE.findall(match.group(3)))})
         if not devices:
             raise DeviceNotFoundError('Devices not found')
-        return devices
+        self.__devices_cache = (time.monotonic(), devices)
+        return [{'serial': d['serial'], 'type': d['type'], 'description': dict(d['description'])} for d in devices]
+
+    def invalidate_devices_cache(self) -> None:
+        """
+        Забыть запомненный список устройств, чтобы следующий get_devices() заново спросил adb
+
+        """
+        self.__devices_cache = (0.0, None)
 
     def set_device(self, serial: str) -> None:
         """
@@ -208,7 +489,67 @@ class AndroidAdb(object):
         Если подключено более одного устройства/эмулятора, то adb -s serial будет необходим. Взять serial устройства
         можно из get_devices()[индекс устройства в списке].get('serial')
         """
+        if serial != self.__device:
+            self.close_shell()
+            self.refresh_props()
+            self.__packages_cache = None
         self.__device = serial
+        self.__base_command = (self.__adb,) if serial is None else (self.__adb, '-s', serial)
+
+    def __clone_for(self, serial: str) -> 'AndroidAdb':
+        """
+        Сделать копию объекта, привязанную к другому устройству. Настройки (пакет, строки выхода из логката) копируются,
+         а всё, что относится к конкретному устройству (shell, логкат, запомненные property), у копии своё
+
+        :param serial: id устройства для копии
+        :return: новый объект AndroidAdb
+        """
+        clone = copy.copy(self)
+        clone.__device = serial
+        clone.__base_command = (self.__adb, '-s', serial)
+        clone.__logcat = None
+        clone.__logcat_lines = None
+        clone.__logcat_condition = None
+        clone.__logcat_thread = None
+        clone.__shell = None
+        clone.__shell_finalizer = None
+        clone.__shell_lock = threading.Lock()
+        clone.__prop_cache = {}
+        clone.__props_time = None
+        clone.__sdk_version = None
+        clone.__runtime_permissions = None
+        clone.__pending = []
+        clone.__packages_cache = None
+        return clone
+
+    def parallel(self, serials: Iterable, method: str, *args, max_workers: int = None, **kwargs) -> dict:
+        """
+        Выполнить один и тот же метод сразу на нескольких устройствах, каждое в своём потоке. Удобно для установки,
+         пуша файлов и сбора property с кучи подключенных устройств
+
+        :param serials: id устройств, см. get_devices()
+        :param method: имя метода этого класса, например 'install'
+        :param args: позиционные аргументы для метода
+        :param max_workers: сколько устройств обрабатывать одновременно. По умолчанию все сразу. Если установки
+         отваливаются по таймауту, уменьшите, вплоть до 1 (последовательно)
+        :param kwargs: именованные аргументы для метода
+        :return: словарь {serial: результат}. Если метод упал с исключением, вместо результата будет само исключение
+        """
+        clones = {serial: self.__clone_for(serial) for serial in serials}
+        if not clones:
+            return {}
+        results = {}
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers or len(clones)) as executor:
+            futures = {serial: executor.submit(getattr(clone, method), *args, **kwargs)
+                       for serial, clone in clones.items()}
+            for serial, future in futures.items():
+                try:
+                    results[serial] = future.result()
+                except Exception as e:
+                    results[serial] = e
+        for clone in clones.values():
+            clone.close_shell()
+        return results
 
     def set_package(self, package: str) -> None:
         """
@@ -224,6 +565,7 @@ class AndroidAdb(object):
         Переподключить устройство
 
         """
+        self.invalidate_devices_cache()
         self.__execute_adb_run('reconnect')
 
     def install(self, apk_file: str, replace: bool = False, downgrade: bool = False,
@@ -245,45 +587,228 @@ class AndroidAdb(object):
         :param sdcard: устанавить на карту
         :return: словарь {'Success': bool, 'Message': str}. 'Message' есть только в случае проблем установки
         """
-        command = ['install']
+        flags = self.__get_install_flags(replace, downgrade, permissions, auto_permissions, allow_test, sdcard)
+        returncode, output = _execute_command_tail(self.__get_adb_command('install', *flags, apk_file))
+        result = _check_install_remove(output, Mode.INSTALL, returncode)
+        if result.get('Success'):
+            self.__packages_cache = None
+        return result
+
+    def __get_install_flags(self, replace: bool = False, downgrade: bool = False, permissions: bool = False,
+                            auto_permissions: bool = False, allow_test: bool = True, sdcard: bool = False) -> list:
+        """
+        Собрать ключи установки, общие для adb install и pm install. Смысл параметров см. в install()
+
+        :return: список ключей
+        """
+        flags = []
         if replace:
-            command.append('-r')
+            flags.append('-r')
         if downgrade:
-            command.append('-d')
-        if permissions:
-            command.append('-g')
-        elif auto_permissions:
-            if self.get_sdk_version() > 22:
-                if auto_permissions:
-                    command.append('-g')
+            flags.append('-d')
+        if permissions or (auto_permissions and self.__supports_runtime_permissions()):
+            flags.append('-g')
         if allow_test:
-            command.append('-t')
+            flags.append('-t')
         if sdcard:
-            command.append('-s')
-        command.append(apk_file)
+            flags.append('-s')
+        return flags
+
+    def __supports_runtime_permissions(self) -> bool:
+        """
+        Узнать, есть ли на устройстве рантайм пермишены (Android 6+, API 23). Ответ запоминается до смены устройства
+         или refresh_props()
+
+        :return: булевое, понимает ли установщик ключ -g
+        """
+        if self.__runtime_permissions is None:
+            self.__runtime_permissions = self.get_sdk_version() > 22
+        return self.__runtime_permissions
+
+    def install_many(self, apk_files: Iterable, replace: bool = False, downgrade: bool = False,
+                     permissions: bool = False, auto_permissions: bool = False, allow_test: bool = True,
+                     sdcard: bool = False) -> dict:
+        """
+        Установить несколько apk подряд. Каждый apk заливается в /data/local/tmp и ставится через pm install в
+         долгоживущем shell. Залитые файлы остаются на устройстве, и если там уже лежит apk с той же md5, повторная
+         заливка пропускается — это сильно экономит время, когда один и тот же apk переустанавливается много раз
+
+        :param apk_files: пути к apk
+        :param replace: и остальные флаги — как у install()
+        :return: словарь {apk: результат install()}. Если установка упала с исключением, вместо результата будет
+         само исключение
+        """
+        flags = self.__get_install_flags(replace, downgrade, permissions, auto_permissions, allow_test, sdcard)
+        results = {}
+        for apk_file in apk_files:
+            try:
+                remote = self.__push_apk(apk_file)
+                returncode, output = self.__execute_shell_rc(' '.join(['pm', 'install', *flags, shlex.quote(remote)]))
+                results[apk_file] = _check_install_remove(output, Mode.INSTALL, returncode)
+                self.__packages_cache = None
+            except Exception as e:
+                results[apk_file] = e
+        return results
+
+    def __push_apk(self, apk_file: str) -> str:
+        """
+        Залить apk в /data/local/tmp, если его там ещё нет или там лежит другая версия (сверяем md5)
+
+        :param apk_file: путь к apk
+        :return: путь к apk на устройстве
+        """
+        remote = _DEVICE_TMP + os.path.basename(apk_file)
+        local_md5 = hashlib.md5()
+        with open(apk_file, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 20), b''):
+                local_md5.update(chunk)
+        if self.get_md5(remote) != local_md5.hexdigest():
+            self.push([apk_file], _DEVICE_TMP)
+        return remote
+
+    def batch(self, commands: Iterable) -> list:
+        """
+        Выполнить пачку независимых команд за один обмен с долгоживущим shell: все команды отправляются разом,
+         а ответы разбираются по маркерам. Поддерживаются:
+         ('install', apk) или ('install', apk, {флаги install()}) — apk сначала заливается, как в install_many();
+         ('uninstall', package);
+         ('shell', 'команда', 'аргументы', ...).
+         Команды выполняются по порядку, но отправляются не дожидаясь ответов, поэтому годится только для команд,
+         не зависящих от результата предыдущих. Все apk заливаются до отправки команд
+
+        :param commands: список кортежей, описанных выше
+        :return: список результатов в том же порядке. Для install/uninstall — словарь, как у install(), или
+         исключение InstallRemoveError, если операция не удалась. Если apk не удалось залить, вместо результата
+         будет это исключение, а сама установка не выполняется. Для shell — список строк вывода
+        """
+        entries = [(kind, args) for kind, *args in commands]
+        for kind, _ in entries:
+            if kind not in ('install', 'uninstall', 'shell'):
+                raise ValueError('Unknown batch command "%s"' % kind)
+
+        results = [None] * len(entries)
+        slots = []
+        scripts = []
+        modes = []
+        for index, (kind, args) in enumerate(entries):
+            if kind == 'install':
+                flags = self.__get_install_flags(**(args[1] if len(args) > 1 else {}))
+                try:
+                    remote = self.__push_apk(args[0])
+                except Exception as e:
+                    results[index] = e
+                    continue
+                scripts.append(' '.join(['pm', 'install', *flags, shlex.quote(remote)]))
+                modes.append(Mode.INSTALL)
+            elif kind == 'uninstall':
+                scripts.append('pm uninstall ' + shlex.quote(args[0]))
+                modes.append(Mode.UNINSTALL)
+            else:
+                scripts.append(' '.join(args))
+                modes.append(None)
+            slots.append(index)
 
-        output = self.__execute_adb_run(*command)
-        return _check_install_remove(output, Mode.INSTALL)
+        for index, mode, (returncode, output) in zip(slots, modes, self.__execute_shell_batch(scripts)):
+            if mode is None:
+                results[index] = output
+                continue
+            try:
+                result = _check_install_remove(output, mode, returncode)
+            except InstallRemoveError as e:
+                result = e
+            else:
+                if result.get('Success'):
+                    self.__packages_cache = None
+            results[index] = result
+        return results
+
+    async def install_async(self, apk_file: str, **kwargs) -> dict:
+        """
+        То же, что install(), но ожидание adb install не блокирует цикл событий
+
+        :param apk_file: путь к apk
+        :param kwargs: флаги, как у install()
+        :return: словарь {'Success': bool, 'Message': str}, как у install()
+        """
+        flags = self.__get_install_flags(**kwargs)
+        returncode, output = await _run_command_async(self.__get_adb_command('install', *flags, apk_file))
+        result = _check_install_remove(output, Mode.INSTALL, returncode)
+        if result.get('Success'):
+            self.__packages_cache = None
+        return result
+
+    async def install_all_async(self, apk_file: str, serials: Iterable = None, max_workers: int = 4,
+                                **kwargs) -> dict:
+        """
+        Асинхронный вариант install_all(): установки на разные устройства идут одновременно в одном цикле событий,
+         без потоков
 
-    def is_installed(self, package: str = None) -> bool:
+        :param apk_file: путь к apk
+        :param serials: id устройств. Если не переданы, ставим на все устройства из get_devices()
+        :param max_workers: сколько установок идёт одновременно
+        :param kwargs: флаги для install()
+        :return: словарь {serial: результат install()}. Если установка упала с исключением, вместо результата будет
+         само исключение
+        """
+        if serials is None:
+            serials = [device['serial'] for device in self.get_devices()]
+        clones = {serial: self.__clone_for(serial) for serial in serials}
+        semaphore = asyncio.Semaphore(max_workers)
+
+        async def install_one(clone: 'AndroidAdb') -> dict:
+            async with semaphore:
+                return await clone.install_async(apk_file, **kwargs)
+
+        results = await asyncio.gather(*(install_one(clone) for clone in clones.values()), return_exceptions=True)
+        for clone in clones.values():
+            clone.close_shell()
+        return dict(zip(clones, results))
+
+    def install_all(self, apk_file: str, serials: Iterable = None, max_workers: int = 4, **kwargs) -> dict:
+        """
+        Установить apk сразу на несколько устройств параллельно, см. parallel()
+
+        :param apk_file: путь к apk
+        :param serials: id устройств. Если не переданы, ставим на все устройства из get_devices()
+        :param max_workers: сколько установок идёт одновременно. Слишком много параллельных установок через один
+         USB-хаб начинают отваливаться по таймауту
+        :param kwargs: флаги для install(), например replace=True
+        :return: словарь {serial: результат install()}. Если установка упала с исключением, вместо результата будет
+         само исключение
+        """
+        if serials is None:
+            serials = [device['serial'] for device in self.get_devices()]
+        return self.parallel(serials, 'install', apk_file, max_workers=max_workers, **kwargs)
+
+    def installed_packages(self, refresh: bool = False) -> frozenset:
+        """
+        Получить набор установленных пакетов. Список запрашивается у pm один раз и запоминается до успешной
+         установки/удаления через этот объект или смены устройства
+
+        :param refresh: не верить запомненному набору и спросить pm заново
+        :return: frozenset имён пакетов
+        """
+        if refresh or self.__packages_cache is None:
+            pm_lines = self.execute_pm('list', 'packages')
+            self.__packages_cache = frozenset(line[8:] for line in pm_lines if line.startswith('package:'))
+        return self.__packages_cache
+
+    def is_installed(self, package: str = None, refresh: bool = False) -> bool:
         """
         Проверить, установлен ли пакет
         :param package: пакет, который нужно проверить. Если пакет не передан, используем тот, что был задан по
          умолчанию. Если пакет по умолчанию не установлен — ловим искллючение
+        :param refresh: перечитать список пакетов, см. installed_packages(). Нужно, если пакеты ставились
+         в обход этого объекта
         :return: булевое установлен или нет
         """
-        command = ['list', 'packages']
         if package is None:
             if self.__package is not None:
                 package = self.__package
             else:
                 raise PackageNameError('Package name not defined')
 
-        pm_lines = self.execute_pm(*command)
-        if 'package:' + package in pm_lines:
-            return True
-        else:
-            return False
+        return package in self.installed_packages(refresh)
 
     def uninstall(self, package: str = None) -> dict:
         """
@@ -296,8 +821,11 @@ class AndroidAdb(object):
             package = self.__package
             if not package:
                 raise PackageNameError('Package name not defined')
-        output = self.__execute_adb_run('uninstall', package)
-        return _check_install_remove(output, Mode.UNINSTALL)
+        returncode, output = _execute_command_tail(self.__get_adb_command('uninstall', package))
+        result = _check_install_remove(output, Mode.UNINSTALL, returncode)
+        if result.get('Success'):
+            self.__packages_cache = None
+        return result
 
     def execute_pm(self, *args, output: bool = True) -> list:
         """
@@ -309,43 +837,68 @@ class AndroidAdb(object):
         """
         return self.adb_shell_run('pm', *args, output=output)
 
-    def start_logcat(self, clear: bool = True, log_format: str = 'threadtime') -> None:
+    def start_logcat(self, clear: bool = True, log_format: str = 'threadtime', max_lines: int = 100000,
+                     buffers: Iterable = None) -> subprocess.Popen:
         """
         Начать читать логкат. Чтение будет происходить в отдельном потоке, из которого потом нужно будет забрать данные
 
         :param clear: предварительно очистить логкат от старых записей
         :param log_format: формат вывода логката. Читайте справку. По умолчанию всё нормас, верьте мне
-        """
-        self.__check_logcat()
+        :param max_lines: сколько последних строк держать в памяти, пока их никто не забрал. Более старые строки
+         выбрасываются. None — хранить всё
+        :param buffers: какие буферы логката читать, например ('main', 'system', 'crash') или ('all',). Все они
+         читаются одним процессом, а переход между буферами отмечается строкой '--------- switch to <буфер>'.
+         По умолчанию — буферы, которые logcat читает сам
+        :return: процесс adb logcat. Читать его stdout самостоятельно не нужно — этим занят фоновый поток, а
+         остановить логкат лучше через stop_logcat()
+        """
+        if self.__check_logcat():
+            raise LogcatWorkingError('Previous logcat still working')
         if clear:
             self.clear_logcat()
-        command = []
+        command = _logcat_buffer_args(buffers)
         if log_format:
             command.extend(['-v', log_format])
-        return self.__execute_adb_popen('logcat', *command)
+        return self.__execute_adb_popen('logcat', *command, max_lines=max_lines)
 
-    def dump_logcat(self, log_format: str = 'threadtime') -> list:
+    def dump_logcat(self, log_format: str = 'threadtime', buffers: Iterable = None) -> list:
         """
         Получить дамп вывода логката. Удобно, если вы предварительно очистили вывод от старых записей
 
         :param log_format: формат вывода логката. Читайте справку. По умолчанию всё нормас, верьте мне
+        :param buffers: какие буферы логката выгрузить, см. start_logcat()
         :return: список строк логката
         """
+        return list(self.iter_logcat_dump(log_format, buffers))
+
+    def iter_logcat_dump(self, log_format: str = 'threadtime', buffers: Iterable = None) -> Iterator[str]:
+        """
+        То же, что dump_logcat(), но строки отдаются по мере чтения, а не копятся в памяти. Подходит для больших
+         буферов, которые всё равно разбираются в цикле for
+
+        :param log_format: формат вывода логката
+        :param buffers: какие буферы логката выгрузить, см. start_logcat()
+        :return: генератор строк логката
+        """
         self.__check_logcat()
-        command = ['logcat', '-d']
+        # exec-out не выделяет PTY и не переводит \n в \r\n
+        command = ['exec-out', 'logcat', '-d', *_logcat_buffer_args(buffers)]
         if log_format:
             command.extend(['-v', log_format])
-        results = self.__execute_adb_run(*command)
+        yield from _iter_command(self.__get_adb_command(*command))
         self.stop_logcat()
-        return results
 
-    def clear_logcat(self) -> None:
+    def clear_logcat(self, wait: bool = True) -> None:
         """
         Очистить буфер логката от старых записей
 
+        :param wait: дождаться окончания очистки. Если False, команда уйдёт в фон, дождаться её можно через flush()
         """
         self.__check_logcat()
-        self.__execute_adb_run('logcat', '-c', output=False)
+        if wait:
+            self.adb_shell_run('logcat', '-c', output=False)
+        else:
+            self.__start_adb_command('logcat', '-c')
 
     def stop_logcat(self) -> None:
         """
@@ -354,29 +907,47 @@ class AndroidAdb(object):
 
         """
         if self.__logcat is not None:
-            if self.__logcat.poll is not None:
+            if self.__logcat.poll() is None:
                 self.__logcat.terminate()
-                time.sleep(2)
+                try:
+                    self.__logcat.wait(timeout=0.5)
+                except subprocess.TimeoutExpired:
+                    self.__logcat.kill()
+                    self.__logcat.wait()
+        if self.__logcat_thread is not None:
+            self.__logcat_thread.join(timeout=2)
+        if self.__logcat is not None and not self.__logcat_thread.is_alive():
+            self.__logcat.stdout.close()  # поток уже дочитал трубу, можно закрывать не мешая ему
         self.__logcat = None
+        self.__logcat_lines = None
+        self.__logcat_condition = None
+        self.__logcat_thread = None
 
-    def read_logcat(self, timeout: int = None) -> list:
+    def read_logcat(self, timeout: int = None, stop: bool = True) -> list:
         """
         Прочесть, чего там в логкате накопилось к этому времени и убить поток.
 
+        :param timeout: сколько секунд дать логкату на накопление строк перед чтением. По умолчанию 3 секунды, если
+         логкат останавливается, и 0, если нет
+        :param stop: остановить логкат после чтения. Если False, логкат продолжит писать в буфер, а следующий вызов
+         вернёт только то, что накопилось с прошлого чтения
         :return: список строк, по которому можете итерироваться как Гвидо на душу положит
         """
         if self.__logcat is None:
             raise LogcatNotDefinedError('Logcat not defined')
 
         if timeout is None:
-            timeout = 3
-        try:
-            out, err = self.__logcat.communicate(timeout=timeout)
-        except subprocess.TimeoutExpired:
-            self.__logcat.terminate()
-            out, err = self.__logcat.communicate()
-        self.stop_logcat()
-        return _prepare_output(out)
+            timeout = 3 if stop else 0
+        if timeout:
+            self.__logcat_thread.join(timeout)  # Логкат сам не завершается, так что просто даём ему накопить строк
+        with self.__logcat_condition:
+            lines = list(self.__logcat_lines)
+            self.__logcat_lines.clear()
+            if lines and lines[-1] is None:
+                self.__logcat_lines.append(None)  # признак конца нужен и следующим читателям
+        if stop:
+            self.stop_logcat()
+        return _prepare_output(b''.join(line for line in lines if line is not None))
 
     def read_logcat_while_line(self, end_line: str, start_line: str = None,
                                timeout: int = None, decode: str = 'utf-8') -> list:
@@ -436,21 +1007,21 @@ class AndroidAdb(object):
          отваливаться по таймауту, а выйти сразу после падения
         :param lines: список/набор/кортеж ключевых строк
         """
-        if isinstance(lines, (list, set, tuple)):
-            self.__exit_lines = set(lines)
+        if isinstance(lines, (list, set, frozenset, tuple)):
+            self.__exit_lines = frozenset(lines)
         else:
-            raise TypeError('Expected list or tuple or set but %s got' % type(list))
+            raise TypeError('Expected list or tuple or set but %s got' % type(lines))
 
     def clear_logcat_exit_lines(self) -> None:
         """
         Очистить дополнительный список строк, при появлении которых в логкате, мы бы оттуда сразу вышли
         """
-        self.__exit_lines.clear()
+        self.__exit_lines = frozenset()
 
-    def get_logcat_exit_lines(self) -> set:
+    def get_logcat_exit_lines(self) -> frozenset:
         """
         Получить глобальный список строк, по которым возможен выход при чтении логката
-        :return: набор ключевых строк
+        :return: неизменяемый набор ключевых строк. Чтобы поменять набор, используйте методы *_logcat_exit_lines()
         """
         return self.__exit_lines
 
@@ -461,14 +1032,14 @@ class AndroidAdb(object):
          отваливаться по таймауту, а выйти сразу после падения
         :param lines: список/набор/кортеж ключевых строк
         """
-        self.__exit_lines.update(lines)
+        self.__exit_lines = self.__exit_lines.union(lines)
 
     def remove_logcat_exit_lines(self, lines: Iterable) -> None:
         """
         Сузить набор ключевых строк, по которым возможен выход из логката.
         :param lines: список/набор/кортеж ключевых строк
         """
-        self.__exit_lines = self.__exit_lines - set(lines)
+        self.__exit_lines = self.__exit_lines.difference(lines)
 
     def read_logcat_while_lines(self, end_lines: list, start_lines: list = None, timeout: int = None,
                                 decode: str = 'utf-8') -> list:
@@ -489,53 +1060,139 @@ class AndroidAdb(object):
         if self.__logcat is None:
             raise LogcatNotDefinedError('Logcat not defined')
 
-        start_time = time.time()
-
         if start_lines:
-            pattern_start = re.compile('|'.join(start_lines))
+            search_start = self.__get_logcat_pattern(start_lines, decode).search
         else:
-            pattern_start = None
+            search_start = None
 
-        if self.__exit_lines:
-            end_lines += self.__exit_lines
-        pattern_end = re.compile('|'.join(set(end_lines)))
-        found = False
+        search_end = self.__get_logcat_pattern(frozenset(end_lines) | self.__exit_lines, decode).search
         result = []
-        if start_lines is not None:
-            can_start = False
-        else:
+        result_append = result.append
+        if search_start is None:
             can_start = True
+        else:
+            can_start = False
 
-        while not found:
-            if timeout is not None:
-                if time.time() - start_time > timeout:
-                    self.stop_logcat()
-                    raise TimeoutError('Timeout for reading logcat')
-            log_str = self.__logcat.stdout.readline().decode(decode).strip()
-            if not can_start:
-                if re.search(pattern_start, log_str):
-                    can_start = True
-            if can_start:
-                if log_str not in ('', '\n', '\r'):
-                    result.append(log_str)
-            if re.search(pattern_end, log_str):
-                found = True
+        try:
+            for raw_line in self.__iter_logcat_lines(timeout):
+                if not can_start:
+                    if search_start(raw_line):
+                        can_start = True
+                if can_start:
+                    raw_line = raw_line.strip()
+                    if raw_line:
+                        result_append(raw_line.decode(decode, 'replace'))
+                if search_end(raw_line):
+                    break
+        except TimeoutError:
+            self.stop_logcat()
+            raise
         self.stop_logcat()
         return result
 
-    def __execute_adb_popen(self, *args) -> None:
+    async def read_logcat_while_lines_async(self, end_lines: list, start_lines: list = None, timeout: float = None,
+                                            decode: str = 'utf-8', clear: bool = True,
+                                            log_format: str = 'threadtime') -> list:
+        """
+        То же самое, что read_logcat_while_lines(), но для asyncio: логкат запускается и читается без блокировки
+         потока, так что в одном потоке можно одновременно следить за логкатами нескольких устройств. Логкат
+         запускается самим методом, start_logcat() вызывать не нужно
+
+        :param end_lines: список ключевых строк, по которым нужно прекратить чтение. Расширяется строками из
+         set_logcat_exit_lines()
+        :param start_lines: список ключевых строк, с которых нужно начать накапливать строки. Если его нет, то строки
+         будут накапливаться с первой же
+        :param timeout: максимальное время в секундах, выделенное на ожидание финальной строки
+        :param decode: кодировка для декодирования строк. По умолчанию utf-8
+        :param clear: предварительно очистить логкат от старых записей
+        :param log_format: формат вывода логката
+        :return: список накопленных строк
+        """
+        if start_lines:
+            search_start = self.__get_logcat_pattern(start_lines, decode).search
+        else:
+            search_start = None
+        search_end = self.__get_logcat_pattern(frozenset(end_lines) | self.__exit_lines, decode).search
+
+        if clear:
+            await (await _start_logcat_async(self.__base_command, '-c')).wait()
+        command = []
+        if log_format:
+            command.extend(['-v', log_format])
+        process = await _start_logcat_async(self.__base_command, *command)
+        try:
+            return await asyncio.wait_for(_collect_logcat_async(process.stdout, search_start, search_end, decode),
+                                          timeout)
+        except asyncio.TimeoutError:
+            raise TimeoutError('Timeout for reading logcat')
+        finally:
+            if process.returncode is None:
+                process.terminate()
+            await process.wait()
+
+    def __iter_logcat_lines(self, timeout: float = None):
+        """
+        Построчно забирать вывод запущенного логката из буфера, который наполняет фоновый поток, до завершения
+         логката. Пока строк нет, ждём их на условии, поэтому таймаут соблюдается точно, даже если логкат молчит
+        :param timeout: максимальное время в секундах на чтение. None - без ограничения
+        :return: генератор сырых строк (bytes)
+        """
+        lines = self.__logcat_lines
+        condition = self.__logcat_condition
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            with condition:
+                while not lines:
+                    remaining = None
+                    if deadline is not None:
+                        remaining = deadline - time.monotonic()
+                        if remaining <= 0:
+                            raise TimeoutError('Timeout for reading logcat')
+                    condition.wait(remaining)
+                batch = list(lines)
+                lines.clear()
+            for raw_line in batch:
+                if raw_line is None:  # логкат завершился, ждать больше нечего
+                    return
+                if deadline is not None and time.monotonic() > deadline:
+                    raise TimeoutError('Timeout for reading logcat')
+                yield raw_line
+
+    def __get_logcat_pattern(self, lines: Iterable, encoding: str = 'utf-8') -> re.Pattern:
+        """
+        Получить скомпилированное регулярное выражение, срабатывающее на любую из ключевых строк. Выражение строится
+         над байтами, чтобы строки логката можно было проверять без декодирования. Выражения запоминаются, так что
+         повторное чтение логката с теми же строками не компилирует их заново
+
+        :param lines: ключевые строки
+        :param encoding: кодировка логката, в которой ключевые строки переводятся в байты
+        :return: скомпилированное выражение
+        """
+        key = (frozenset(lines), encoding)
+        pattern = self.__pattern_cache.get(key)
+        if pattern is None:
+            pattern = re.compile(b'|'.join(line.encode(encoding) for line in key[0]))
+            self.__pattern_cache[key] = pattern
+        return pattern
+
+    def __execute_adb_popen(self, *args, max_lines: int = None) -> subprocess.Popen:
         """
         Выполняем команды adb с переданными параметрами в отдельном треде
 
         :param args: аргументы. Список, кортеж, набор, словарь — это всё 1 аргумент! Так что если у вас итерируемый
         объект, то не забывайте его разворачивать, как мама в дестве учила: *[]
-        """
-        command = [self.__adb]
-        serial = self.__device
-        if serial is not None:
-            command.extend(['-s', serial])
-        command.extend([*args])
-        self.__logcat = subprocess.Popen(command, stdout=subprocess.PIPE)
+        :param max_lines: размер кольцевого буфера, в который фоновый поток складывает вывод
+        :return: запущенный процесс
+        """
+        self.__logcat = subprocess.Popen(self.__get_adb_command(*args), stdout=subprocess.PIPE, close_fds=_CLOSE_FDS)
+        _grow_pipe(self.__logcat.stdout)
+        self.__logcat_lines = collections.deque(maxlen=max_lines)
+        self.__logcat_condition = threading.Condition()
+        self.__logcat_thread = threading.Thread(target=_drain_logcat, daemon=True,
+                                                args=(self.__logcat.stdout, self.__logcat_lines,
+                                                      self.__logcat_condition))
+        self.__logcat_thread.start()
+        return self.__logcat
 
     def __execute_adb_run(self, *args, output: bool = True) -> list:
         """
@@ -547,34 +1204,35 @@ class AndroidAdb(object):
          проверка вида if output будет False
         :return: выхлоп в виде списка строк
         """
-        command = [self.__adb]
-        serial = self.__device
-        if serial is not None:
-            command.extend(['-s', serial])
-        command.extend([*args])
-        return _execute_command(command, output=output)
+        return _execute_command(self.__get_adb_command(*args), output=output)
+
+    def __get_adb_command(self, *args) -> list:
+        """
+        Собрать полную команду adb для текущего устройства
+
+        :param args: аргументы adb
+        :return: список аргументов для subprocess
+        """
+        return [*self.__base_command, *args]
 
     def __check_logcat(self, auto_kill: bool = False) -> bool:
         """
-        Проверяем, а не использует ли у нас логкат сейчас.
+        Проверяем, а не использует ли у нас логкат сейчас. Если прошлый логкат уже завершился сам, ссылка на него
+         тихо освобождается
 
-        :type auto_kill: булевое рибивать ли процесс логката, если он не был убит в прошлый раз или выбросить исключение
+        :type auto_kill: булевое рибивать ли процесс логката, если он ещё жив. Об этом будет предупреждение
         :return: булевое жив ли процесс на данный момент
         """
-        if self.__logcat is not None:
-            if self.__logcat.poll() is not None:
-                if auto_kill:
-                    self.stop_logcat()
-                    return False
-                else:
-                    raise LogcatWorkingError('Previous logcat still working')
-            else:
-                if auto_kill:
-                    self.__logcat = None
-                    return False
-                else:
-                    return True
-        return False
+        if self.__logcat is None:
+            return False
+        if self.__logcat.poll() is not None:
+            self.stop_logcat()
+            return False
+        if auto_kill:
+            warnings.warn('Previous logcat still working and will be stopped', UserWarning, stacklevel=3)
+            self.stop_logcat()
+            return False
+        return True
 
     def get_android_version(self) -> str:
         """
@@ -590,11 +1248,13 @@ class AndroidAdb(object):
 
         :return: интовое значение с версией SDK вида 22. Если версию получить не удалось, будет отрицательное число.
         """
-        v = self.get_prop('ro.build.version.sdk')
-        if v:
-            return int(v)
-        else:
-            return -1
+        if self.__sdk_version is None:
+            v = self.get_prop('ro.build.version.sdk')
+            if v:
+                self.__sdk_version = int(v)
+            else:
+                return -1
+        return self.__sdk_version
 
     def get_api_level(self) -> int:
         """
@@ -617,13 +1277,57 @@ class AndroidAdb(object):
         Получить какой-нибудь property в виде строки
 
         :param param: название property, типа 'ro.product.locale.language'
-        :return: строка со значением. Либо пустая строка, если такого property нет
+        :return: строка со значением. Либо пустая строка, если такого property нет. При первом обращении с устройства
+         читаются сразу все property. Значения ro.* дальше берутся из памяти до смены устройства или вызова
+         refresh_props(), остальные перечитываются, если запомнены больше props_ttl секунд назад
         """
-        prop = self.adb_shell_run('getprop', param)
-        if prop:
-            return prop[0]
-        else:
-            return ''
+        if param.startswith('ro.') and param in self.__prop_cache:
+            return self.__prop_cache[param]
+        if self.__props_time is None or time.monotonic() - self.__props_time >= self.__props_ttl:
+            self.__prime_prop_cache()
+        return self.__prop_cache.get(param, '')
+
+    def get_props(self, params: Iterable) -> dict:
+        """
+        Получить сразу несколько property. Все они читаются с устройства за один вызов getprop
+
+        :param params: названия property, например ['ro.build.version.release', 'ro.build.version.sdk']
+        :return: словарь {название: значение}. Для отсутствующих property значение — пустая строка
+        """
+        return {param: self.get_prop(param) for param in params}
+
+    def __prime_prop_cache(self) -> None:
+        """
+        Прочитать все property устройства одним вызовом getprop и запомнить их
+
+        """
+        props = {}
+        for line in self.adb_shell_run('getprop'):
+            match = _PROP_RE.match(line)
+            if match is not None:
+                props[match.group(1)] = match.group(2)
+        self.__prop_cache = props
+        self.__props_time = time.monotonic()
+
+    def refresh_props(self) -> None:
+        """
+        Забыть запомненные значения property, чтобы следующие запросы перечитали их с устройства
+
+        """
+        self.__prop_cache.clear()
+        self.__props_time = None
+        self.__sdk_version = None
+        self.__runtime_permissions = None
+
+    def invalidate_cache(self) -> None:
+        """
+        Забыть всё запомненное об устройствах: список устройств, property и установленные пакеты. Пригодится после
+         переподключения или перепрошивки железа
+
+        """
+        self.invalidate_devices_cache()
+        self.refresh_props()
+        self.__packages_cache = None
 
     def create_activity(self, activity: str, package: str = None, args: list = None) -> None:
         """
@@ -639,26 +1343,31 @@ class AndroidAdb(object):
             else:
                 package = self.__package
 
-        command = ['am', 'start', '-n', package + '/' + activity]
-        if args:
-            command.extend(args)
-        self.adb_shell_run(*command, output=False)
+        self.adb_shell_run(*_AM_START_PREFIX, package + '/' + activity, *(args or ()), output=False)
 
-    def push(self, source: list, destination: str, sync: bool = False) -> list:
+    def push(self, source: list, destination: str, sync: bool = False, ensure_dir: bool = False) -> list:
         """
         Закинуть файлы и каталоги на устройство
 
         :param source: список файлов и каталогов. Структура каталогов будет сохранена
         :param destination: куда пушим. Если заданного пути нет, он будет создан
         :param sync: пушить только те файлы, которых не хватает на устройстве и те, которые на устройстве более старые
+        :param ensure_dir: создать destination до заливки. По умолчанию каталог создаётся, только если adb
+         пожаловался на его отсутствие, и заливка повторяется
         :return: список строк, по которым можно понять, какие файлы залились, а какие — нет
         """
         command = ['push', *source, destination]
         if sync:
             command.append('--sync')
 
-        self.mkdir(destination)
+        if ensure_dir:
+            self.mkdir(destination)
         adb_lines = self.__execute_adb_run(*command)
+        dir_error = any(res_line.endswith(_PUSH_DIR_ERRORS) for res_line in adb_lines)
+        # Ту же ошибку adb пишет и про отсутствующий локальный файл — тогда каталог на устройстве ни при чём
+        if not ensure_dir and dir_error and all(os.path.exists(path) for path in source):
+            self.mkdir(destination)
+            adb_lines = self.__execute_adb_run(*command)
         result = []
         for res_line in adb_lines:
             if '%]' not in res_line:
@@ -688,6 +1397,65 @@ class AndroidAdb(object):
                 result.append(res_line)
         return result
 
+    def push_tar(self, source: list, destination: str) -> list:
+        """
+        Закинуть файлы и каталоги на устройство одним tar-потоком через adb exec-in. adb push тратит отдельный обмен
+         на каждый файл, так что для тысяч мелких файлов это заметно быстрее. Нужен tar на устройстве (Android 6+)
+         и adb exec-in (Android 7+)
+
+        :param source: список файлов и каталогов. На устройстве они окажутся прямо в destination под своими именами
+        :param destination: куда пушим. Если заданного пути нет, он будет создан
+        :return: вывод tar на устройстве. Пустой список, если всё прошло гладко
+        """
+        remote = shlex.quote(destination)
+        command = self.__get_adb_command('exec-in', 'mkdir -p %s && tar -xf - -C %s' % (remote, remote))
+        with subprocess.Popen(command, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                              close_fds=_CLOSE_FDS) as process:
+            # Вывод читаем параллельно с записью: если tar на устройстве напишет ошибок больше, чем влезает в трубу,
+            # он встанет, а вместе с ним и наша запись архива
+            output = []
+            reader = threading.Thread(target=lambda: output.append(process.stdout.read()), daemon=True)
+            reader.start()
+            try:
+                try:
+                    with tarfile.open(fileobj=process.stdin, mode='w|') as archive:
+                        for path in source:
+                            archive.add(path, arcname=os.path.basename(os.path.normpath(path)))
+                finally:
+                    process.stdin.close()
+            except BrokenPipeError:  # tar на устройстве упал, причину найдём в выводе
+                pass
+            reader.join()
+            return _prepare_output(output[0] if output else b'')
+
+    def pull_tar(self, source: list, destination: str) -> list:
+        """
+        Стянуть файлы и каталоги с устройства одним tar-потоком через adb exec-out, см. push_tar(). Нужен tar
+         на устройстве (Android 6+). Если у tarfile нет фильтра data (старые Python), ссылки и спецфайлы
+         из архива пропускаются, чтобы через них нельзя было писать за пределы destination
+
+        :param source: откуда тянем. Пути сохраняются относительно корня устройства: /sdcard/a.txt окажется
+         в destination/sdcard/a.txt
+        :param destination: директория, в которую заливаем. Если конечного пути нет, то он будет создан
+        :return: список стянутых путей относительно destination
+        """
+        if not os.path.exists(destination):
+            os.makedirs(destination)
+
+        command = self.__get_adb_command('exec-out', 'tar -cf - ' + ' '.join(shlex.quote(path) for path in source))
+        names = []
+        with subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+                              close_fds=_CLOSE_FDS) as process:
+            with tarfile.open(fileobj=process.stdout, mode='r|') as archive:
+                for member in archive:
+                    if member.name.startswith('/') or '..' in member.name.split('/'):
+                        continue  # не даём архиву писать за пределы destination
+                    if not _TAR_EXTRACT_KWARGS and not (member.isfile() or member.isdir()):
+                        continue  # без фильтра data ссылка может увести запись за пределы destination
+                    archive.extract(member, destination, **_TAR_EXTRACT_KWARGS)
+                    names.append(member.name)
+        return names
+
     def remove(self, files: list, safe: bool = True) -> list:
         """
         Удалить на устройстве файлы и папки
@@ -702,7 +1470,7 @@ class AndroidAdb(object):
             command.append('-f')
         else:
             command.append('-rf')
-        command.append(files)
+        command.extend(files)
 
         return self.adb_shell_run(*command)
 
@@ -717,7 +1485,7 @@ class AndroidAdb(object):
         :param output: нужен ли вам выхлоп выполнения команды в виде списка строк
         :return: список строк
         """
-        command = ['shell']
+        command = []
         if from_package:
             if check_android:
                 if not self.get_sdk_version() > 20:
@@ -725,24 +1493,182 @@ class AndroidAdb(object):
                                                   self.get_sdk_version())
             command.extend(['run-as', self.__package])
         command.extend(args)
-        return self.__execute_adb_run(*command, output=output)
+        result = self.__execute_shell(' '.join(command))
+        return result if output else []
+
+    def __get_shell(self) -> subprocess.Popen:
+        """
+        Получить долгоживущий процесс adb shell, запустив его при первом обращении или если прошлый умер.
+        Через него идут все shell-команды, чтобы не платить за запуск adb и подключение к устройству на каждый вызов
+
+        :return: процесс adb shell
+        """
+        if self.__shell is None or self.__shell.poll() is not None:
+            self.__shell = subprocess.Popen(self.__get_adb_command('shell'), stdin=subprocess.PIPE,
+                                            stdout=subprocess.PIPE, stderr=subprocess.STDOUT, bufsize=0,
+                                            close_fds=_CLOSE_FDS)
+            self.__shell_finalizer = weakref.finalize(self, _close_process, self.__shell)
+        return self.__shell
+
+    def __execute_shell(self, command: str) -> list:
+        """
+        Выполнить команду в долгоживущем adb shell
+
+        :param command: строка с командой, как её набрали бы в шелле
+        :return: вывод команды в виде списка строк
+        """
+        return self.__execute_shell_rc(command)[1]
+
+    def __execute_shell_rc(self, command: str) -> tuple:
+        """
+        Выполнить команду в долгоживущем adb shell
+
+        :param command: строка с командой, как её набрали бы в шелле
+        :return: кортеж (код возврата, вывод команды в виде списка строк)
+        """
+        return self.__execute_shell_batch([command])[0]
+
+    def __execute_shell_batch(self, commands: list) -> list:
+        """
+        Выполнить команды в долгоживущем adb shell, отправив их разом. Каждая команда идёт в своём subshell со stdin
+         из /dev/null: cd, export, exit и set -e не переживают команду, а читающая stdin команда не съест следующие.
+         Конец вывода каждой команды определяем по маркеру с кодом возврата, который печатаем сразу после неё.
+         Маркер случайный на каждый обмен, так что вывод команды не может его подделать. Всё, кроме первой команды,
+         пишется из отдельного потока, пока мы читаем вывод: иначе большой вывод забил бы трубу, и обе стороны
+         ждали бы друг друга. Обращения из разных потоков выполняются по очереди. Если shell умер ещё до отправки,
+         команды выполняются отдельными adb shell, как раньше
+
+        :param commands: строки с командами, как их набрали бы в шелле
+        :return: список кортежей (код возврата, вывод команды в виде списка строк) в порядке команд
+        """
+        if not commands:
+            return []
+        marker = _END_MARKER % os.urandom(8).hex()
+        end_re = re.compile(re.escape(marker.encode()) + rb'(\d+)\r?\n')
+        frames = ['( %s\n) </dev/null 2>&1; echo %s$?\n' % (command, marker) for command in commands]
+        with self.__shell_lock:
+            shell = self.__get_shell()
+            try:
+                shell.stdin.write(frames[0].encode())
+            except OSError:  # shell умер между проверкой и записью, команды до устройства не дошли
+                self.close_shell()
+                return [self.__execute_shell_once(command) for command in commands]
+            if len(frames) > 1:  # остальное пишем из потока, чтобы большой вывод не упёрся в нашу запись
+                threading.Thread(target=_write_quietly, args=(shell.stdin, ''.join(frames[1:]).encode()),
+                                 daemon=True).start()
+            selector = None
+            if _USE_SELECTORS and self.__shell_timeout is not None:
+                selector = selectors.DefaultSelector()
+                selector.register(shell.stdout, selectors.EVENT_READ)
+                deadline = time.monotonic() + self.__shell_timeout
+            try:
+                # Труба небуферизованная, поэтому читаем кусками, а не readline(), который тянул бы по байту
+                results = []
+                buffer = bytearray()
+                start = search_from = 0
+                while len(results) < len(commands):
+                    match = end_re.search(buffer, search_from)
+                    if match is None:
+                        if selector is not None:
+                            remaining = deadline - time.monotonic()
+                            if remaining <= 0 or not selector.select(remaining):
+                                self.close_shell()
+                                raise TimeoutError('adb shell did not answer "%s" in %s seconds' %
+                                                   (commands[len(results)], self.__shell_timeout))
+                        chunk = shell.stdout.read(_READ_SIZE)
+                        if not chunk:
+                            self.close_shell()
+                            raise DeviceNotFoundError('adb shell terminated while executing "%s"' %
+                                                      commands[len(results)])
+                        search_from = max(start, len(buffer) - len(marker) - 8)
+                        buffer += chunk
+                        continue
+                    results.append((int(match.group(1)), _prepare_output(bytes(buffer[start:match.start()]))))
+                    start = search_from = match.end()
+                return results
+            finally:
+                if selector is not None:
+                    selector.close()
+
+    def __execute_shell_once(self, command: str) -> tuple:
+        """
+        Выполнить команду отдельным adb shell, без долгоживущего процесса
+
+        :param command: строка с командой
+        :return: кортеж (код возврата, вывод команды в виде списка строк)
+        """
+        result = subprocess.run(self.__get_adb_command('shell', command), stdout=subprocess.PIPE,
+                                stderr=subprocess.STDOUT, close_fds=_CLOSE_FDS)
+        return result.returncode, _prepare_output(result.stdout)
+
+    def close_shell(self) -> None:
+        """
+        Завершить долгоживущий adb shell, если он был запущен. При выходе из скрипта это будет сделано автоматически
+
+        """
+        if self.__shell_finalizer is not None:
+            self.__shell_finalizer()
+        self.__shell = None
+        self.__shell_finalizer = None
+
+    def adb_exec_out_run(self, *args, output: bool = True) -> list:
+        """
+        Выполнить команду через adb exec-out. В отличие от adb shell, exec-out никогда не выделяет PTY, поэтому вывод
+         приходит как есть: без замены \\n на \\r\\n и без порчи бинарных данных. Подходит для команд с большим или
+         бинарным выводом (cat, screencap и т.п.).
+         Учтите: аргументы на устройстве всё равно склеиваются через пробел и разбираются sh, так что пути с пробелами
+         и спецсимволами нужно экранировать самостоятельно. Для частых мелких команд adb_shell_run() быстрее — он не
+         запускает новый adb на каждый вызов
 
-    def mkdir(self, destination: PathLike) -> None:
+        :param args: аргументы
+        :param output: нужен ли вам выхлоп выполнения команды в виде списка строк
+        :return: список строк
+        """
+        return self.__execute_adb_run('exec-out', *args, output=output)
+
+    def mkdir(self, destination: PathLike, wait: bool = True) -> None:
         """
         Создать директорию любого уровня вложенности
 
         :param destination: путь, который нужно создать
+        :param wait: дождаться создания. Если False, команда запускается отдельным adb в фоне, и несколько таких
+         команд выполняются одновременно. Дождаться их можно через flush(). Если от результата зависят следующие
+         команды (например, push в эту папку), сначала вызовите flush()
         """
         command = ['mkdir', '-p', destination]
-        self.adb_shell_run(*command, output=False)
+        if wait:
+            self.adb_shell_run(*command, output=False)
+        else:
+            self.__start_adb_command('shell', *command)
 
-    def rmdir(self, destination: PathLike) -> None:
+    def rmdir(self, destination: PathLike, wait: bool = True) -> None:
         """Удалить директорию и все вложенные объекты. Осторожно!
 
         :param destination: путь, который нужно рекурсивно удалить. Удаляются вложенные объекты, но не наддиректории
+        :param wait: дождаться удаления. Если False, команда уйдёт в фон, см. mkdir()
         """
         command = ['rm', '-rf', destination]
-        self.adb_shell_run(*command, output=False)
+        if wait:
+            self.adb_shell_run(*command, output=False)
+        else:
+            self.__start_adb_command('shell', *command)
+
+    def __start_adb_command(self, *args) -> None:
+        """
+        Запустить команду adb в фоне и запомнить процесс, чтобы потом дождаться его в flush()
+
+        :param args: аргументы
+        """
+        self.__pending.append(_execute_command_async(self.__get_adb_command(*args)))
+
+    def flush(self) -> None:
+        """
+        Дождаться завершения всех команд, запущенных в фоне (mkdir/rmdir/clear_logcat с wait=False)
+
+        """
+        pending, self.__pending = self.__pending, []
+        for process in pending:
+            process.wait()
 
     def get_full_ls_info(self, target: PathLike, from_package: bool = False) -> tuple:
         """
@@ -839,9 +1765,9 @@ class AndroidAdb(object):
 
         for md5_name in possible_md5:
             res = self.adb_shell_run(md5_name, target, from_package=from_package, check_android=False)
-            if any(['not found' in res[0],
-                    'No such file or directory' in res[0],
-                    'Permission denied' in res[0]]):
+            if not res:  # md5sum ничего не напечатал — считаем, что хеш не получили
+                continue
+            if 'not found' in res[0] or 'No such file or directory' in res[0] or 'Permission denied' in res[0]:
                 continue
             else:
                 md5_str = res[0].split(' ')[0].strip()
@@ -1,28 +1,135 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 import os
-from typing import Union
+import stat
+import subprocess
+import threading
+from typing import Final, Union
 
 PathLike = Union[bytes, str]
 
+_IS_WINDOWS: Final = os.name == 'nt'
+_EXE_SUFFIX: Final = '.exe' if _IS_WINDOWS else ''
+_UTIL_NAMES: Final = {
+    'adb': 'adb' + _EXE_SUFFIX,
+    'aapt': 'aapt' + _EXE_SUFFIX,
+    'zipalign': 'zipalign' + _EXE_SUFFIX,
+    'emulator': 'emulator' + _EXE_SUFFIX,
+    'apksigner': 'apksigner.bat' if _IS_WINDOWS else 'apksigner',  # на Windows это скрипт, а не exe
+}
+_ADB_REL: Final = os.path.join('platform-tools', _UTIL_NAMES['adb'])  # пути к утилитам относительно SDK
+_EMULATOR_REL: Final = os.path.join('tools', _UTIL_NAMES['emulator'])
+_DIR: Final = 'dir'  # значения obj_type для _path_checker()
+_FILE: Final = 'file'
+_NO_WARM_UP_ENV: Final = 'ANDROID_SDK_NO_ADB_WARM_UP'  # если задана, set_adb() не запускает сервер adb
+_warmed_up_adb = set()
+_stat_cache = {}
+
+
+def _stat(path: PathLike) -> tuple:
+    """
+    Узнать, что лежит по пути, одним вызовом stat. Найденные пути запоминаются: раскладка SDK за время работы скрипта
+     обычно не меняется. Если всё-таки поменялась, см. _invalidate(). Отсутствие пути не запоминаем, чтобы утилиту,
+     поставленную уже после первой проверки, можно было задать без перезапуска скрипта
+
+    :param path: путь без переменных окружения
+    :return: кортеж (существует, это папка, это файл)
+    """
+    try:
+        mode = _stat_cache[path]
+    except KeyError:
+        try:
+            mode = os.stat(path, follow_symlinks=False).st_mode
+            if stat.S_ISLNK(mode):  # SDK из пакетов дистрибутива бывает на ссылках — смотрим, куда ведёт
+                mode = os.stat(path).st_mode
+        except OSError:
+            return False, False, False
+        _stat_cache[path] = mode
+    return True, stat.S_ISDIR(mode), stat.S_ISREG(mode)
+
+
+def _invalidate(path: PathLike = None) -> None:
+    """
+    Забыть запомненные stat для пути и всего, что лежит внутри него
+
+    :param path: путь без переменных окружения. Если не передан, забываем всё
+    """
+    if path is None:
+        _stat_cache.clear()
+        return
+    prefix = os.path.join(path, b'' if isinstance(path, bytes) else '')
+    for cached in [p for p in _stat_cache if type(p) is type(path) and (p == path or p.startswith(prefix))]:
+        del _stat_cache[cached]
+
+
+def _warm_up_adb(adb: PathLike) -> None:
+    """
+    Запустить adb start-server в фоне, чтобы к первой настоящей команде сервер adb уже работал. Первый запуск
+     сервера занимает пару секунд, а так они проходят, пока скрипт занят чем-то ещё. Для каждого adb — один раз
+     за время работы скрипта, если запуск удался. Отключается переменной окружения ANDROID_SDK_NO_ADB_WARM_UP
+
+    :param adb: путь к adb
+    """
+    if adb in _warmed_up_adb or os.environ.get(_NO_WARM_UP_ENV):
+        return
+    _warmed_up_adb.add(adb)
+
+    def start_server() -> None:
+        try:
+            started = subprocess.run([adb, 'start-server'], stdout=subprocess.DEVNULL,
+                                     stderr=subprocess.DEVNULL).returncode == 0
+        except OSError:  # не запустился — не страшно, первая команда adb поднимет сервер сама
+            started = False
+        if not started:  # забываем, чтобы следующий set_adb() попробовал снова
+            _warmed_up_adb.discard(adb)
+
+    threading.Thread(target=start_server, daemon=True).start()
+
+
+def _version_key(version: str) -> tuple:
+    """
+    Ключ для сортировки версий build-tools по смыслу, а не по алфавиту: 9.0.0 < 30.0.3. Нечисловые части вроде
+     0-rc1 не учитываются, поэтому предварительная версия оказывается раньше финальной
+
+    :param version: имя каталога с версией
+    :return: кортеж чисел
+    """
+    return tuple(int(part) for part in version.split('.') if part.isdigit())
+
+
+def _expand(path: PathLike) -> PathLike:
+    """
+    Раскрыть в пути переменные окружения и ~. Строку трогаем, только если там действительно есть что раскрывать
+
+    :param path: путь, возможно с переменными окружения
+    :return: путь без переменных окружения
+    """
+    dollar, percent, tilde = (b'$', b'%', b'~') if isinstance(path, bytes) else ('$', '%', '~')
+    if dollar in path or percent in path:
+        path = os.path.expandvars(path)
+    if path.startswith(tilde):
+        path = os.path.expanduser(path)
+    return path
+
 
 def _path_checker(path: PathLike, obj_type: str) -> bool:
     """
     Проверяем переданные пути к фалам и папкам
 
     :param path: сам путь к файлу или папке. Переменные окружения разрешены
-    :param obj_type: что передали то — файл или папку?
+    :param obj_type: что передали то — файл (_FILE) или папку (_DIR)?
     :return:
     """
-    path = os.path.expanduser(os.path.expandvars(path))
-    if os.path.exists(path):
-        if obj_type == "dir":
-            if os.path.isdir(path):
+    path = _expand(path)
+    exists, is_dir, is_file = _stat(path)
+    if exists:
+        if obj_type == _DIR:
+            if is_dir:
                 return True
             else:
                 raise IsADirectoryError(f'"{path}" is not a directory')
-        elif obj_type == "file":
-            if os.path.isfile(path):
+        elif obj_type == _FILE:
+            if is_file:
                 return True
             else:
                 raise FileNotFoundError(f'"{path}" is not file')
@@ -33,6 +140,9 @@ def _path_checker(path: PathLike, obj_type: str) -> bool:
 
 
 class AndroidSdk(object):
+    __slots__ = ('__sdk', '__adb', '__aapt', '__zipalign', '__apksigner', '__emulator', '__build_tools',
+                 '__build_tools_files', '__select_last', '__auto_setters')
+
     def __init__(self, path: PathLike = None, auto_set: list = None, select_last: bool = True) -> None:
         """
         Конструктор, чё тут ещё сказать
@@ -42,23 +152,23 @@ class AndroidSdk(object):
         :param auto_set: список утилит, которые нужно автоматически найти (адб, аапт, вот это всё)
         :param select_last: если установлено несколько версий утилит, брать последнюю. Актуально для build-tools
         """
-        self.__util_name = {'adb': 'adb', 'aapt': 'aapt', 'zipalign': 'zipalign', 'emulator': 'emulator'}
-        if os.name == 'nt':
-            for key in self.__util_name:
-                self.__util_name[key] = self.__util_name.get(key) + '.exe'
-
         self.__sdk = None
         self.__adb = None
         self.__aapt = None
         self.__zipalign = None
+        self.__apksigner = None
         self.__emulator = None
+        self.__build_tools = None
+        self.__build_tools_files = None
         self.__select_last = select_last
+        self.__auto_setters = {'adb': self.set_adb, 'aapt': self.set_aapt, 'zipalign': self.set_zipalign,
+                               'apksigner': self.set_apksigner, 'emulator': self.set_emulator}
 
         if path:
             if auto_set is None:
                 auto_set = []
             if isinstance(auto_set, list):
-                self.set_sdk(os.path.expanduser(os.path.expandvars(path)), auto_set)
+                self.set_sdk(path, auto_set)
             else:
                 raise AttributeError('Auto_set must be list type')
 
@@ -69,8 +179,12 @@ class AndroidSdk(object):
         :param path: путь к SDK. Переменные окружения разрешены
         :param auto_set: список утилит, которые нужно автоматически найти (адб, аапт, вот это всё)
         """
-        if _path_checker(path, "dir"):
+        path = _expand(path)
+        _invalidate(path)
+        if _path_checker(path, _DIR):
             self.__sdk = path
+            self.__build_tools = None
+            self.__build_tools_files = None
             if auto_set:
                 self.__auto_set(auto_set)
 
@@ -79,21 +193,60 @@ class AndroidSdk(object):
         Попытаться найти build-tools, если они нужны
 
         :return: путь к build-tools/version/
-        Где /version/ — вложенная директория
+        Где /version/ — вложенная директория. Найденный путь запоминается до смены SDK
+        """
+        if self.__build_tools is None:
+            self.__build_tools = self.__find_build_tools_dir()
+        return self.__build_tools
+
+    def __find_build_tools_dir(self) -> str:
+        """
+        Найти build-tools/version/ в SDK, см. __get_build_tools_dir()
+
+        :return: путь к build-tools/version/
         """
         expected_build_tools = os.path.join(self.__sdk, 'build-tools')
-        if _path_checker(expected_build_tools, "dir"):
-            internal_dirs = sorted(os.listdir(expected_build_tools))
+        if _path_checker(expected_build_tools, _DIR):
+            with os.scandir(expected_build_tools) as entries:
+                internal_dirs = [entry.name for entry in entries if entry.is_dir()]
             if not internal_dirs:
                 raise OSError("Build tools not installed")
             elif len(internal_dirs) == 1:
-                return os.path.join(expected_build_tools, internal_dirs)
+                return os.path.join(expected_build_tools, internal_dirs[0])
             else:
                 if self.__select_last:
-                    return os.path.join(expected_build_tools, internal_dirs[-1])
+                    return os.path.join(expected_build_tools, max(internal_dirs, key=_version_key))
                 else:
                     raise ValueError("Build tools has different versions")
 
+    def __scan_build_tools(self) -> dict:
+        """
+        Один раз прочитать содержимое build-tools/version/, чтобы искать там утилиты без отдельного stat на каждую.
+         Результат запоминается до смены SDK
+
+        :return: словарь {имя файла: путь к нему}
+        """
+        if self.__build_tools_files is None:
+            with os.scandir(self.__get_build_tools_dir()) as entries:
+                self.__build_tools_files = {entry.name: entry.path for entry in entries if entry.is_file()}
+        return self.__build_tools_files
+
+    def __find_build_tool(self, name: str) -> PathLike:
+        """
+        Найти утилиту в build-tools/version/. Если в прочитанном списке файлов её нет, проверяем путь как раньше,
+         чтобы получить понятную ошибку
+
+        :param name: название утилиты без расширения
+        :return: путь к утилите
+        """
+        file_name = _UTIL_NAMES[name]
+        try:
+            return self.__scan_build_tools()[file_name]
+        except KeyError:
+            expected_path = os.path.join(self.__get_build_tools_dir(), file_name)
+            if _path_checker(expected_path, _FILE):
+                return expected_path
+
     def get_sdk(self) -> PathLike:
         """
         Вспомнить путь к SDK, если вдруг забыли
@@ -110,12 +263,13 @@ class AndroidSdk(object):
         :param path: путь к утилите adb, включая её саму
         """
         if path:
-            if _path_checker(path, "file"):
+            if _path_checker(path, _FILE):
                 self.__adb = path
         else:
-            expected_adb_path = os.path.join(self.__sdk, 'platform-tools', self.__util_name.get('adb'))
-            if _path_checker(expected_adb_path, "file"):
+            expected_adb_path = os.path.join(self.__sdk, _ADB_REL)
+            if _path_checker(expected_adb_path, _FILE):
                 self.__adb = expected_adb_path
+        _warm_up_adb(_expand(self.__adb))
 
     def get_adb(self) -> PathLike:
         """
@@ -133,13 +287,10 @@ class AndroidSdk(object):
         :param path: путь к утилите appt, включая её саму
         """
         if path:
-            if _path_checker(path, 'file'):
+            if _path_checker(path, _FILE):
                 self.__aapt = path
         else:
-            build_tools = self.__get_build_tools_dir()
-            expected_aapt = os.path.join(build_tools, self.__util_name.get('aapt'))
-            if _path_checker(expected_aapt, 'file'):
-                self.__aapt = expected_aapt
+            self.__aapt = self.__find_build_tool('aapt')
 
     def get_aapt(self) -> PathLike:
         """
@@ -156,13 +307,10 @@ class AndroidSdk(object):
         :param path: путь к утилите, включая её саму
         """
         if path:
-            if _path_checker(path, "file"):
+            if _path_checker(path, _FILE):
                 self.__zipalign = path
         else:
-            build_tools = self.__get_build_tools_dir()
-            expected_path = os.path.join(build_tools, self.__util_name.get('zipalign'))
-            if _path_checker(expected_path, 'file'):
-                self.__zipalign = expected_path
+            self.__zipalign = self.__find_build_tool('zipalign')
 
     def get_zipalign(self) -> PathLike:
         """
@@ -172,6 +320,26 @@ class AndroidSdk(object):
         """
         return self.__zipalign
 
+    def set_apksigner(self, path: PathLike = None) -> None:
+        """
+        Задать путь к утилите apksigner, либо заменить на новый
+
+        :param path: путь к утилите, включая её саму
+        """
+        if path:
+            if _path_checker(path, _FILE):
+                self.__apksigner = path
+        else:
+            self.__apksigner = self.__find_build_tool('apksigner')
+
+    def get_apksigner(self) -> PathLike:
+        """
+        Получить путь к утилите apksigner
+
+        :return: путь к утилите apksigner
+        """
+        return self.__apksigner
+
     def set_emulator(self, path: PathLike = None) -> None:
         """
         Задать путь к утилите emulator
@@ -179,11 +347,11 @@ class AndroidSdk(object):
         :param path: путь к утилите, включая сам файл emulator
         """
         if path:
-            if _path_checker(path, 'file'):
+            if _path_checker(path, _FILE):
                 self.__emulator = path
         else:
-            expected_path = os.path.join(self.__sdk, 'tools', self.__util_name.get('emulator'))
-            if _path_checker(expected_path, 'file'):
+            expected_path = os.path.join(self.__sdk, _EMULATOR_REL)
+            if _path_checker(expected_path, _FILE):
                 self.__emulator = expected_path
 
     def get_emulator(self) -> PathLike:
@@ -201,16 +369,10 @@ class AndroidSdk(object):
         :param set_list: названия утилит без расширений в виде списка
         """
         for name in set_list:
-            if name == 'adb':
-                self.set_adb()
-            elif name == 'aapt':
-                self.set_aapt()
-            elif name == 'zipalign':
-                self.set_zipalign()
-            elif name == 'emulator':
-                self.set_emulator()
-            else:
+            setter = self.__auto_setters.get(name)
+            if setter is None:
                 raise AttributeError('Unknown parameter: %s' % name)
+            setter()
 
 
 if __name__ == '__main__':